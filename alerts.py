@@ -0,0 +1,106 @@
+# Edge-triggered alerts with debounce and hysteresis
+#
+# A tracker follows one condition per device. The alert is raised once the
+# condition held for `raise_after` seconds, and cleared once it was false
+# for `clear_after` seconds. An alert is not raised again less than
+# `cooldown` seconds after its last raise, so a flapping device pings at
+# most once per cooldown.
+import threading
+
+RAISE = "raise"
+CLEAR = "clear"
+
+
+class AlertState:
+    __slots__ = ("bad_since", "good_since", "active", "raised_at")
+
+    def __init__(self):
+        self.bad_since = None
+        self.good_since = None
+        self.active = False
+        self.raised_at = None
+
+
+class AlertTracker:
+    """
+    Track one alert condition per device.
+    """
+
+    def __init__(self, raise_after=0, clear_after=0, cooldown=0):
+        self.raise_after = raise_after
+        self.clear_after = clear_after
+        self.cooldown = cooldown
+        self._states = dict()
+        self._lock = threading.Lock()
+
+    def _state(self, key):
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = AlertState()
+        return state
+
+    def update(self, key, bad, now):
+        """
+        Feed the current condition of a device.
+
+        Args:
+            key: Device key.
+            bad (bool): The alert condition holds.
+            now (float): Monotonic time in seconds.
+
+        Returns:
+            RAISE or CLEAR on an edge, None otherwise.
+        """
+        with self._lock:
+            state = self._state(key)
+            if bad:
+                state.good_since = None
+                if state.bad_since is None:
+                    state.bad_since = now
+                if (state.active
+                        or now - state.bad_since < self.raise_after):
+                    return None
+                if (state.raised_at is not None
+                        and now - state.raised_at < self.cooldown):
+                    return None
+                state.active = True
+                state.raised_at = now
+                return RAISE
+            state.bad_since = None
+            if not state.active:
+                return None
+            if state.good_since is None:
+                state.good_since = now
+            if now - state.good_since < self.clear_after:
+                return None
+            state.active = False
+            return CLEAR
+
+    def prime(self, key, bad, now):
+        """
+        Set the state of a device without an edge, when starting up.
+        """
+        with self._lock:
+            state = self._state(key)
+            state.active = bad
+            state.bad_since = now if bad else None
+            state.good_since = None
+            state.raised_at = now if bad else None
+
+    def settled(self, key):
+        """
+        Return whether feeding an unchanged condition cannot cause an edge,
+        so the device need not be fed until its condition changes.
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return True
+            if state.active:
+                return state.good_since is None
+            return state.bad_since is None
+
+    def active(self):
+        with self._lock:
+            return sorted(key for key, state in self._states.items()
+                          if state.active)
@@ -0,0 +1,116 @@
+# Asyncio runtime of cmd-monitor
+#
+# The MQTT client (aiomqtt) and the Slack app (Bolt AsyncApp served by
+# aiohttp) share one event loop, so connections and in-flight HTTP requests
+# cost no thread. Slash commands run on the loop and await the broker, MQTT
+# publishes made from any thread, such as the reply workers, are scheduled on
+# the loop through MqttBridge.
+#
+# aiomqtt and aiohttp are only needed for this runtime, and imported when it
+# starts.
+import asyncio
+import logging
+
+# Seconds before connecting again after losing the broker
+RECONNECT_SEC = 5
+
+
+class ReceivedMessage:
+    """
+    MQTT message with the attributes of a paho one used by the handlers.
+    """
+    __slots__ = ("topic", "payload", "qos", "retain")
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class MqttBridge:
+    """
+    paho-like publish and subscribe over an aiomqtt client, callable from
+    any thread. Calls are queued on the loop and do not wait.
+    """
+
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+
+    def _schedule(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error("MQTT call failed: %s", future.exception())
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return self._schedule(self.client.publish(topic, payload, qos=qos,
+                                                  retain=retain))
+
+    def subscribe(self, topic, qos=0):
+        return self._schedule(self.client.subscribe(topic, qos=qos))
+
+
+async def serve_slack(app, port, path="/slack/events"):
+    """
+    Serve a Bolt AsyncApp on the running loop.
+
+    Returns:
+        The aiohttp runner, to clean up when done.
+    """
+    from aiohttp import web
+
+    runner = web.AppRunner(app.web_app(path=path, port=port))
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    logging.info("Serving Slack requests on port %d", port)
+    return runner
+
+
+def create_mqtt_client(conf, client_id):
+    """
+    Create the MQTT client from the contents of .mqtt-config.json, on the
+    running loop. It connects once run_mqtt runs.
+
+    Returns:
+        The MqttBridge of the client.
+    """
+    import aiomqtt
+
+    client = aiomqtt.Client(
+        conf["broker_addr"], int(conf["broker_port"]),
+        username=conf["username"], password=conf["password"],
+        identifier=client_id, keepalive=60)
+    return MqttBridge(client, asyncio.get_running_loop())
+
+
+async def run_mqtt(bridge, on_connect, on_message):
+    """
+    Connect to the broker and dispatch messages until cancelled,
+    reconnecting when the connection is lost.
+
+    Args:
+        bridge (MqttBridge): Bridge of the client to connect.
+        on_connect: paho-style callback, called after each connection.
+        on_message: paho-style callback, called on the loop for each
+            message.
+    """
+    import aiomqtt
+
+    while True:
+        try:
+            async with bridge.client as client:
+                on_connect(bridge, None, None, 0)
+                async for message in client.messages:
+                    on_message(bridge, None, ReceivedMessage(
+                        message.topic.value, message.payload, message.qos,
+                        message.retain))
+        except aiomqtt.MqttError as e:
+            logging.error("MQTT connection lost: %s, reconnecting in %ds",
+                          e, RECONNECT_SEC)
+            await asyncio.sleep(RECONNECT_SEC)
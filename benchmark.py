@@ -0,0 +1,440 @@
+# Synthetic-fleet benchmark of the monitors hot paths
+#
+# Runs pi-monitor and cmd-monitor handlers against generated fleets with an
+# in-process broker stand-in and fake Firebase and Slack, then prints one JSON
+# document with msgs/sec, p50/p99 latency and peak memory per scenario.
+#
+#   python benchmark.py --devices 1000 10000 --output bench.json
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import platform
+import queue
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from datetime import datetime, timedelta, timezone
+
+from paho.mqtt.client import topic_matches_sub
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_LINE = ("2024-05-01 12:00:00,000 INFO speedtest: download 93.4 Mbps, "
+            "upload 11.2 Mbps, latency 18 ms, server 12345")
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+class FleetGenerator:
+    """
+    Generate a registry and realistic MQTT payloads for a synthetic fleet.
+    """
+
+    def __init__(self, devices, seed=0):
+        self.random = random.Random(seed)
+        self.macs = ["dc:a6:{:02x}:{:02x}:{:02x}:{:02x}".format(
+            *(i >> shift & 0xff for shift in (24, 16, 8, 0)))
+            for i in range(devices)]
+
+    def config_node(self):
+        return {f"key{i}": {"mac": mac, "rpi_id": f"RPI-{i + 1}"}
+                for i, mac in enumerate(self.macs)}
+
+    def iface(self, name, mac, up):
+        return {
+            "name": name,
+            "up": up,
+            "ip_address": (f"10.{self.random.randint(0, 255)}."
+                           f"{self.random.randint(0, 255)}.2" if up else None),
+            "mac_address": mac,
+        }
+
+    def status(self, mac):
+        # Mostly fresh reports, some old and some very old ones
+        age_min = self.random.choice(
+            [self.random.randint(0, 60)] * 8
+            + [self.random.randint(121, 2000), self.random.randint(20161,
+                                                                   90000)])
+        timestamp = datetime.now(timezone.utc) - timedelta(minutes=age_min)
+        ifaces = [self.iface("lo", "00:00:00:00:00:00", True),
+                  self.iface("eth0", mac, self.random.random() > 0.1),
+                  self.iface("wlan0", mac, self.random.random() > 0.2)]
+        if self.random.random() > 0.5:
+            ifaces.append(self.iface("wlan1", mac, self.random.random() > 0.5))
+        return {
+            "mac": mac,
+            "timestamp": timestamp.isoformat(),
+            "out": {
+                "ifaces": ifaces,
+                "ssid": "eduroam",
+                "srv": {"mqtt": "active", "speedtest": "active"},
+                "git": "a1b2c3d",
+            },
+        }
+
+    def reply(self, mac, cmd_type, seq):
+        out = {
+            "ping": lambda: {"pong": str(seq)},
+            "status": lambda: self.status(mac)["out"],
+            "logs/speedtest": lambda: {"log": "\n".join(
+                [LOG_LINE] * self.random.choice([5, 20, 2000]))},
+            "restartsrv": lambda: {"returncode": {"mqtt": 0,
+                                                  "speedtest": 0}},
+        }[cmd_type]()
+        return {
+            "mac": mac,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "type": cmd_type,
+            "result": "success",
+            "out": out,
+            "err": None,
+        }
+
+
+class FakeMessage:
+    __slots__ = ("topic", "payload", "qos", "retain", "queued_at")
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.queued_at = time.perf_counter()
+
+
+class FakeBroker:
+    """
+    In-process stand-in for the MQTT broker, with retained messages.
+    """
+
+    def __init__(self):
+        self.retained = dict()
+        self.clients = list()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if retain:
+            self.retained[topic] = payload
+        for client in self.clients:
+            if client.matches(topic):
+                client.deliver(FakeMessage(topic, payload, qos, retain))
+
+
+class FakeClient:
+    """
+    Stand-in for a connected paho client, with its own network thread.
+    """
+
+    def __init__(self, broker, on_message=None):
+        self.broker = broker
+        self.on_message = on_message
+        self.subscriptions = set()
+        self.latencies = list()
+        self._queue = queue.Queue()
+        broker.clients.append(self)
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def matches(self, topic):
+        return any(topic_matches_sub(sub, topic) for sub in self.subscriptions)
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.add(topic)
+        for retained_topic, payload in list(self.broker.retained.items()):
+            if topic_matches_sub(topic, retained_topic):
+                self.deliver(FakeMessage(retained_topic, payload, qos, True))
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.broker.publish(topic, payload, qos, retain)
+
+    def deliver(self, msg):
+        self._queue.put(msg)
+
+    def _loop(self):
+        while True:
+            msg = self._queue.get()
+            try:
+                self.on_message(self, None, msg)
+            finally:
+                self.latencies.append(time.perf_counter() - msg.queued_at)
+                self._queue.task_done()
+
+    def join(self):
+        self._queue.join()
+
+
+class FakeSlack:
+    """
+    Record Slack posts, standing in for both the webhook and the WebClient.
+    """
+
+    def __init__(self, delay_sec=0.0):
+        self.delay_sec = delay_sec
+        self.posts = 0
+        self.uploads = 0
+        self.posted_at = dict()
+
+    def _record(self, blocks):
+        now = time.perf_counter()
+        self.posts += 1
+        for block in blocks:
+            text = block.get("text", {}).get("text", "")
+            for seq in re.findall(r"Pong: (\d+)", text):
+                self.posted_at[int(seq)] = now
+        if self.delay_sec:
+            time.sleep(self.delay_sec)
+
+    def webhook(self, url, blocks):
+        self._record(blocks)
+
+    def chat_postMessage(self, channel, blocks, **kwargs):
+        self._record(blocks)
+
+    def files_getUploadURLExternal(self, filename, length):
+        return {"upload_url": "http://slack.invalid/upload",
+                "file_id": filename}
+
+    def post(self, url, data, **kwargs):
+        # Stands in for the upload HTTP session, drains the file body
+        while data.read(64 * 1024):
+            pass
+        return self
+
+    def raise_for_status(self):
+        pass
+
+    def files_completeUploadExternal(self, files, channel_id):
+        self.uploads += 1
+
+
+class FakeApp:
+    """
+    Stand-in for slack_bolt.App, enough to import cmd-monitor.
+    """
+
+    def __init__(self, **kwargs):
+        self.client = None
+
+    def command(self, name):
+        return lambda function: function
+
+    def start(self, port):
+        pass
+
+
+@contextlib.contextmanager
+def quiet_stdout():
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+def load_modules(workdir, config_node, slack):
+    """
+    Import the monitors wired to the stand-ins.
+
+    Args:
+        workdir (string): Directory for the dummy config files, becomes cwd.
+        config_node (dict): Firebase `config` node served by the registry.
+        slack (FakeSlack): Recorder of the Slack posts.
+
+    Returns:
+        The (pi-monitor, cmd-monitor) modules.
+    """
+    with open(os.path.join(workdir, ".slack-config.json"), "w") as file:
+        json.dump({"url": "http://slack.invalid", "bot_token": "xoxb-bench",
+                   "signing_secret": "bench", "slack_port": 0}, file)
+    with open(os.path.join(workdir, ".mqtt-config.json"), "w") as file:
+        json.dump({"username": "bench", "password": "bench",
+                   "broker_addr": "localhost", "broker_port": 1883}, file)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+    slack_bolt = types.ModuleType("slack_bolt")
+    slack_bolt.App = FakeApp
+    sys.modules["slack_bolt"] = slack_bolt
+
+    import firebase
+    import slack_sender
+    firebase.registry.ttl_sec = float("inf")
+    firebase.registry.load(config_node)
+    slack_sender._config = {"url": "http://slack.invalid"}
+    slack_sender._webhook_sender = slack_sender.SlackSender(slack.webhook)
+
+    pi_monitor = importlib.import_module("pi-monitor")
+    argv = sys.argv
+    sys.argv = ["cmd-monitor", "--log-level", "error"]
+    try:
+        cmd_monitor = importlib.import_module("cmd-monitor")
+    finally:
+        sys.argv = argv
+    cmd_monitor.app.client = slack
+    cmd_monitor.reply_sender.post = slack_sender.WebClientPoster(slack)
+    cmd_monitor.log_uploader.client = slack
+    cmd_monitor.log_uploader.session = slack
+    return pi_monitor, cmd_monitor
+
+
+def scenario_pi_on_message(modules, fleet, slack):
+    pi_monitor, _ = modules
+    import firebase
+    messages = [FakeMessage(f"Schmidt/{mac.replace(':', '-')}/report/status",
+                            json.dumps(fleet.status(mac)).encode())
+                for mac in fleet.macs]
+    collector = pi_monitor.FleetCollector(firebase.get_rpi_ids())
+    latencies = list()
+    start = time.perf_counter()
+    for msg in messages:
+        msg_start = time.perf_counter()
+        collector.on_message(None, None, msg)
+        latencies.append(time.perf_counter() - msg_start)
+    return len(messages), time.perf_counter() - start, latencies
+
+
+def scenario_pi_main(modules, fleet, slack):
+    pi_monitor, _ = modules
+    broker = FakeBroker()
+    for mac in fleet.macs:
+        broker.publish(f"Schmidt/{mac.replace(':', '-')}/report/status",
+                       json.dumps(fleet.status(mac)), retain=True)
+    client = FakeClient(broker, pi_monitor.dispatch)
+    start = time.perf_counter()
+    with quiet_stdout():
+        pi_monitor.main(timeout_sec=60, client=client)
+    return len(fleet.macs), time.perf_counter() - start, client.latencies
+
+
+def scenario_cmd_on_message(modules, fleet, slack):
+    _, cmd_monitor = modules
+    broker = FakeBroker()
+    client = FakeClient(broker, cmd_monitor.on_message)
+    client.subscribe(cmd_monitor.topic_report_conf)
+    cmd_monitor.client = client
+    cmd_types = ["ping", "ping", "status", "restartsrv", "logs/speedtest"]
+    published = dict()
+    start = time.perf_counter()
+    for seq, mac in enumerate(fleet.macs):
+        cmd_type = cmd_types[seq % len(cmd_types)]
+        payload = json.dumps(fleet.reply(mac, cmd_type, seq))
+        if cmd_type == "ping":
+            published[seq] = time.perf_counter()
+        broker.publish(f"Schmidt/{mac.replace(':', '-')}/report/config",
+                       payload)
+    client.join()
+    cmd_monitor.reply_dispatcher.join()
+    cmd_monitor.reply_sender.flush()
+    elapsed = time.perf_counter() - start
+    latencies = [slack.posted_at[seq] - sent
+                 for seq, sent in published.items() if seq in slack.posted_at]
+    return len(fleet.macs), elapsed, latencies
+
+
+SCENARIOS = {
+    "pi_monitor.on_message": scenario_pi_on_message,
+    "pi_monitor.main": scenario_pi_main,
+    "cmd_monitor.on_message": scenario_cmd_on_message,
+}
+
+
+def run_scenario(name, devices, slack_delay, measure_memory):
+    fleet = FleetGenerator(devices)
+    slack = FakeSlack(slack_delay)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    cwd = os.getcwd()
+    try:
+        modules = load_modules(workdir, fleet.config_node(), slack)
+        count, elapsed, latencies = SCENARIOS[name](modules, fleet, slack)
+        posts, uploads = slack.posts, slack.uploads
+        peak = None
+        if measure_memory:
+            # Second pass under tracemalloc, which slows everything down
+            fleet = FleetGenerator(devices)
+            tracemalloc.start()
+            SCENARIOS[name](modules, fleet, slack)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    finally:
+        os.chdir(cwd)
+    return {
+        "scenario": name,
+        "devices": devices,
+        "messages": count,
+        "seconds": round(elapsed, 6),
+        "msgs_per_sec": round(count / elapsed, 1) if elapsed else None,
+        "p50_ms": (round(percentile(latencies, 50) * 1000, 3)
+                   if latencies else None),
+        "p99_ms": (round(percentile(latencies, 99) * 1000, 3)
+                   if latencies else None),
+        "peak_memory_bytes": peak,
+        "slack_posts": posts,
+        "slack_uploads": uploads,
+    }
+
+
+def run_isolated(name, devices, slack_delay, measure_memory):
+    # Each scenario runs in a fresh interpreter so module state and
+    # allocations do not leak between scenarios
+    import subprocess
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", name,
+         "--devices", str(devices), "--slack-delay", str(slack_delay)]
+        + ([] if measure_memory else ["--no-memory"]),
+        capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic-fleet benchmark")
+    parser.add_argument("--devices", type=int, nargs="+",
+                        default=[1000, 10000],
+                        help="Fleet sizes to run, default=1000 10000")
+    parser.add_argument("--scenario", choices=list(SCENARIOS),
+                        action="append",
+                        help="Scenario to run, default=all")
+    parser.add_argument("--slack-delay", type=float, default=0.0,
+                        help="Simulated Slack post latency in seconds")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Skip the peak memory pass")
+    parser.add_argument("--output",
+                        help="Write the JSON results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, args.devices[0],
+                                      args.slack_delay, not args.no_memory)))
+        sys.exit(0)
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": list(),
+    }
+    for devices in args.devices:
+        for name in args.scenario or SCENARIOS:
+            result = run_isolated(name, devices, args.slack_delay,
+                                  not args.no_memory)
+            print(f"{name} @ {devices}: {result['msgs_per_sec']} msgs/s, "
+                  f"p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms",
+                  file=sys.stderr)
+            results["results"].append(result)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,98 @@
+# Change-only reporting
+#
+# A tool keeps the state of each device from its previous run in a local
+# snapshot, and reports only the devices whose state changed since.
+import json
+import os
+
+SNAPSHOT_VERSION = 1
+
+
+def load_states(path):
+    """
+    Load the device states of the previous run.
+
+    Returns:
+        A dict of device: state list, or None without a usable snapshot.
+    """
+    try:
+        with open(path, 'r') as file:
+            snapshot = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return snapshot["states"]
+
+
+def save_states(states, path):
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'w') as file:
+            json.dump({"version": SNAPSHOT_VERSION, "states": states}, file)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Error writing state snapshot: {e}")
+
+
+def diff_states(previous, current):
+    """
+    Compare two runs.
+
+    Args:
+        previous (dict): Device: state list of the previous run.
+        current (dict): Device: state list of this run.
+
+    Returns:
+        A (changed, added, removed) tuple of sorted device lists.
+    """
+    changed = sorted(device for device, state in current.items()
+                     if device in previous and previous[device] != state)
+    added = sorted(current.keys() - previous.keys())
+    removed = sorted(previous.keys() - current.keys())
+    return changed, added, removed
+
+
+def track_changes(states, path, save=True):
+    """
+    Diff the states against the snapshot of the previous run, then save
+    them as the new snapshot.
+
+    Args:
+        save (bool): Keep the previous snapshot when False, for runs that
+            do not post, so that their changes are still reported next time.
+
+    Returns:
+        The previous states and the diff_states tuple, or (None, None) on
+        the first run.
+    """
+    previous = load_states(path)
+    if save:
+        save_states(states, path)
+    if previous is None:
+        return None, None
+    return previous, diff_states(previous, states)
+
+
+def mark_change(old, new):
+    """
+    Return a table cell showing a state value, with its previous value if
+    it changed.
+    """
+    if old is None or old == new:
+        return new
+    return f"{old} -> {new}"
+
+
+def summary(total, changed, added, removed):
+    """
+    Return the one-line summary of a change-only report.
+    """
+    if not (changed or added or removed):
+        return f"No change since the last run ({total} devices)"
+    parts = [f"{len(changed)} changed"]
+    if added:
+        parts.append(f"{len(added)} new")
+    if removed:
+        parts.append(f"{len(removed)} gone ({', '.join(removed)})")
+    return f"{total} devices, since the last run: {', '.join(parts)}"
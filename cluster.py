@@ -0,0 +1,265 @@
+# Running several cmd-monitor nodes against one broker
+#
+# The nodes of a group subscribe to the command replies through an MQTT
+# shared subscription ($share/<group>/...), so the broker hands each reply to
+# a single node. The node that published a command owns its pending request,
+# fan-out and log transfer, so a reply landing elsewhere is forwarded to that
+# node's inbox. Correlation IDs are prefixed with the tag of their node.
+# Replies without an ID (pings, log parts of older firmware) go to the node
+# that last sent a command to the device: before publishing a command, a
+# node announces itself as the owner of the device on a group topic.
+#
+# A slash command may reach more than one node. Every node receiving it
+# claims it on a group topic for a short lease, and the node whose claim the
+# broker delivers first handles it.
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+
+import metrics
+import payloads
+
+TOPIC_PREFIX = "Schmidt/cmd-monitor"
+# Longest wait for a claim to come back from the broker
+CLAIM_TIMEOUT_SEC = 2.0
+# Claims are remembered this long, to drop late duplicates of a command
+CLAIM_TTL_SEC = 60
+# Owners of the devices are remembered this much longer than the command
+# timeout, for late replies
+OWNER_GRACE_SEC = 60
+
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class ForwardedMessage:
+    """
+    Reply unwrapped from an inbox, under its original topic.
+    """
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def _resolve(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+class Cluster:
+    """
+    Membership of this node in a group of cmd-monitor nodes.
+
+    Args:
+        group (str): Group name, shared by the nodes splitting the load.
+        node_id (str): Unique name of this node.
+    """
+
+    def __init__(self, group, node_id=None,
+                 claim_timeout_sec=CLAIM_TIMEOUT_SEC,
+                 claim_ttl_sec=CLAIM_TTL_SEC):
+        self.group = group
+        self.node_id = node_id or default_node_id()
+        self.tag = f"{zlib.crc32(self.node_id.encode()):08x}"
+        self.claim_timeout_sec = claim_timeout_sec
+        self.claim_ttl_sec = claim_ttl_sec
+        self.client = None
+        base = f"{TOPIC_PREFIX}/{group}"
+        self.claims_topic = f"{base}/claims"
+        self.owners_topic = f"{base}/owners"
+        self.inbox_prefix = f"{base}/inbox"
+        self.inbox = f"{self.inbox_prefix}/{self.tag}/"
+        self.forwarded = 0
+        self.claims_won = 0
+        self.claims_lost = 0
+        # Command key: (first claiming node, monotonic time seen)
+        self._claims = dict()
+        # Topic MAC: (owner tag, monotonic expiry), in announcement order
+        self._owners = dict()
+        # Command key: [(loop, future)] of the claims waiting for it
+        self._waiters = dict()
+        self._lock = threading.Lock()
+
+    def id_prefix(self):
+        """
+        Return the prefix of the correlation IDs of this node.
+        """
+        return f"{self.tag}."
+
+    def subscribe(self, client, reply_topic):
+        """
+        Subscribe a connected client to the shared replies and the group
+        topics.
+        """
+        self.client = client
+        client.subscribe(f"$share/{self.group}/{reply_topic}")
+        client.subscribe(f"{self.inbox}#", qos=1)
+        client.subscribe(self.claims_topic, qos=1)
+        client.subscribe(self.owners_topic, qos=1)
+
+    def owner(self, corr_id):
+        """
+        Return the tag of the node owning a correlation ID, None if unknown.
+        """
+        if not isinstance(corr_id, str) or "." not in corr_id:
+            return None
+        return corr_id.split(".", 1)[0]
+
+    def own(self, mac, timeout_sec):
+        """
+        Announce that this node is about to send a command to a device, so
+        that its replies without correlation ID come here.
+
+        Args:
+            mac (str): Topic MAC of the device.
+            timeout_sec (int): Reply timeout of the command.
+        """
+        self.client.publish(self.owners_topic, json.dumps(
+            {"mac": mac, "tag": self.tag,
+             "ttl": timeout_sec + OWNER_GRACE_SEC}), qos=1)
+
+    def _on_owner(self, mac, tag, ttl_sec):
+        now = time.monotonic()
+        with self._lock:
+            while self._owners:
+                oldest = next(iter(self._owners))
+                if self._owners[oldest][1] > now:
+                    break
+                del self._owners[oldest]
+            # Re-insert at the end, expiries come in about increasing order
+            self._owners.pop(mac, None)
+            self._owners[mac] = (tag, now + ttl_sec)
+
+    def mac_owner(self, mac):
+        """
+        Return the tag of the node that last sent a command to a device,
+        None if unknown or expired.
+        """
+        with self._lock:
+            owner = self._owners.get(mac)
+        if owner is None or owner[1] <= time.monotonic():
+            return None
+        return owner[0]
+
+    def forward(self, msg, corr_id):
+        """
+        Hand a reply to the node owning its correlation ID or, without one,
+        to the node owning its device.
+
+        Returns:
+            True if the reply was forwarded, False if it is for this node.
+        """
+        if isinstance(msg, ForwardedMessage):
+            # Already routed, owner tables may briefly disagree
+            return False
+        owner = self.owner(corr_id)
+        if owner is None:
+            owner = self.mac_owner(payloads.topic_mac(msg.topic))
+        if owner is None or owner == self.tag:
+            return False
+        self.client.publish(f"{self.inbox_prefix}/{owner}/{msg.topic}",
+                            msg.payload, qos=1)
+        self.forwarded += 1
+        metrics.CLUSTER_EVENTS.inc(event="forwarded")
+        return True
+
+    def receive(self, msg):
+        """
+        Handle the group topics of an incoming message.
+
+        Returns:
+            The message to handle as a reply or status, None if it was a
+            group message.
+        """
+        topic = msg.topic
+        if not topic.startswith(TOPIC_PREFIX):
+            return msg
+        if topic.startswith(self.inbox):
+            return ForwardedMessage(topic[len(self.inbox):], msg.payload)
+        try:
+            notice = json.loads(msg.payload)
+            if topic == self.claims_topic:
+                self._on_claim(notice["key"], notice["node"])
+            elif topic == self.owners_topic:
+                self._on_owner(notice["mac"], notice["tag"],
+                               float(notice["ttl"]))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error("Invalid group message on %s: %s", topic, e)
+        return None
+
+    def _on_claim(self, key, node_id):
+        now = time.monotonic()
+        with self._lock:
+            # Claims are kept in arrival order, expire the oldest
+            while self._claims:
+                oldest = next(iter(self._claims))
+                if now - self._claims[oldest][1] < self.claim_ttl_sec:
+                    break
+                del self._claims[oldest]
+            if key not in self._claims:
+                self._claims[key] = (node_id, now)
+                for loop, future in self._waiters.pop(key, ()):
+                    loop.call_soon_threadsafe(_resolve, future, node_id)
+
+    async def claim(self, key):
+        """
+        Claim a slash command, waiting without blocking the loop until the
+        broker has ordered the claims.
+
+        Args:
+            key (str): Unique key of the command, its Slack trigger ID.
+
+        Returns:
+            True if this node must handle the command.
+        """
+        if not key:
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._lock:
+            if key in self._claims:
+                future.set_result(self._claims[key][0])
+            else:
+                self._waiters.setdefault(key, []).append(waiter)
+        self.client.publish(self.claims_topic, json.dumps(
+            {"key": key, "node": self.node_id}), qos=1)
+        try:
+            winner = await asyncio.wait_for(future, self.claim_timeout_sec)
+        except asyncio.TimeoutError:
+            # The group topics are unreachable, better handle the command
+            # twice than never
+            logging.warning("Claim of %s timed out, handling it", key)
+            winner = self.node_id
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(key)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters[key]
+        won = winner == self.node_id
+        if won:
+            self.claims_won += 1
+        else:
+            self.claims_lost += 1
+            logging.info("Command %s handled by node %s", key, winner)
+        metrics.CLUSTER_EVENTS.inc(event="claim_won" if won else "claim_lost")
+        return won
+
+    def stats(self):
+        return {
+            "node": self.node_id,
+            "tag": self.tag,
+            "forwarded": self.forwarded,
+            "claims_won": self.claims_won,
+            "claims_lost": self.claims_lost,
+        }
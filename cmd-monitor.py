@@ -1,10 +1,24 @@
 import argparse
+import asyncio
 import json
 from paho.mqtt import client as mqtt
 from slack_bolt import App
 import logging
-from datetime import datetime, timezone
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 import firebase
+import slack_sender
+import dispatcher
+import fanout
+import pending
+import metrics
+import log_transfer
+import payloads
+from fleet_state import FleetState
+import status_store
+import cluster
+import async_runtime
 import importlib
 pi_monitor = importlib.import_module("pi-monitor")
 
@@ -13,7 +27,52 @@ parser.add_argument("--experimental", action="store_true",
                     help="Enable experimental mode")
 parser.add_argument("-l", "--log-level", default="debug",
                     help="Provide logging level, default is warning'")
+parser.add_argument("--workers", type=int, default=4,
+                    help="Number of reply handling workers, default=4")
+parser.add_argument("--queue-size", type=int, default=1000,
+                    help="Queued replies per worker, default=1000")
+parser.add_argument("--drop-policy", choices=dispatcher.POLICIES,
+                    default=dispatcher.DROP_OLDEST,
+                    help=("What to do with a reply when its worker queue is "
+                          f"full, default={dispatcher.DROP_OLDEST}"))
+parser.add_argument("--metrics-port", type=int, default=0,
+                    help=("Serve Prometheus metrics on this local port, "
+                          "default=0 (disabled)"))
+parser.add_argument("--fanout-timeout", type=int,
+                    default=fanout.FANOUT_TIMEOUT_SEC,
+                    help=("Seconds to gather replies of a command sent to "
+                          f"several Pis, default={fanout.FANOUT_TIMEOUT_SEC}"))
+parser.add_argument("--max-spool-mb", type=int,
+                    default=log_transfer.MAX_LOG_BYTES // (1024 * 1024),
+                    help=("Largest log accepted from a Pi, in MiB, "
+                          "default="
+                          f"{log_transfer.MAX_LOG_BYTES // (1024 * 1024)}"))
+parser.add_argument("--max-uploads", type=int,
+                    default=slack_sender.MAX_UPLOADS,
+                    help=("Log files uploaded to Slack at once, "
+                          f"default={slack_sender.MAX_UPLOADS}"))
+parser.add_argument("--gzip-uploads", action="store_true",
+                    help="Upload long logs gzipped")
+parser.add_argument("--store", default=status_store.STORE_PATH,
+                    help=("Append status reports to this history, empty to "
+                          f"disable, default={status_store.STORE_PATH}"))
+parser.add_argument("--group", default=None,
+                    help=("Split reply handling with the other nodes of this "
+                          "group through an MQTT shared subscription"))
+parser.add_argument("--node-id", default=None,
+                    help=("Unique name of this node in its group, "
+                          "default=<hostname>-<pid>"))
+parser.add_argument("--async", dest="async_runtime", action="store_true",
+                    help=("Run MQTT and the Slack app on one asyncio event "
+                          "loop, needs aiomqtt and aiohttp"))
 args = parser.parse_args()
+if args.workers < 1:
+    parser.error("--workers must be at least 1")
+if args.queue_size < 1:
+    parser.error("--queue-size must be at least 1")
+if args.async_runtime and args.drop_policy == dispatcher.BLOCK:
+    # Submitting happens on the event loop, which must never block
+    parser.error(f"--async does not support --drop-policy {dispatcher.BLOCK}")
 logging.basicConfig(level=args.log_level.upper())
 
 command_string = "/pi"
@@ -23,6 +82,10 @@ if args.experimental:
           "the Slack channel.\n")
     command_string += "exp"
     client_id += "-exp"
+node_id = args.node_id or cluster.default_node_id()
+if args.group:
+    # Each node of a group needs its own session on the broker
+    client_id += f"-{node_id}"
 
 with open('.slack-config.json', 'r') as file:
     slack_conf = json.load(file)
@@ -34,7 +97,39 @@ app = App(
     signing_secret=slack_conf["signing_secret"]
 )
 
+# Ordered, rate-limit-aware delivery of command replies
+reply_sender = slack_sender.SlackSender(
+    slack_sender.WebClientPoster(app.client))
+# Streamed uploads of long logs
+log_uploader = slack_sender.FileUploader(app.client, args.max_uploads,
+                                         args.gzip_uploads)
+max_log_bytes = args.max_spool_mb * 1024 * 1024
+# Logs up to this size are posted inline, longer ones as a file
+INLINE_LOG_CHARS = 3000
+LOG_PREVIEW_CHARS = 200
+# Replies older than this are discarded
+REPLY_MAX_AGE_SEC = 600
+
 topic_report_conf = f"Schmidt/+/report/config"
+topic_report_status = pi_monitor.topic
+
+# Latest status per device MAC, kept up to date from the retained status
+# messages
+fleet_status = FleetState()
+fleet_lock = threading.Lock()
+# When the status subscription was made and when the cache last changed
+fleet_since = None
+fleet_updated = None
+# Every status report seen, for the history command
+history = status_store.StatusStore(args.store) if args.store else None
+HISTORY_DAYS = 7
+HISTORY_CHANGES = 20
+
+# Fan-out commands waiting for replies
+fanouts = list()
+fanouts_lock = threading.Lock()
+# Event loop of the asyncio runtime, None with the threaded one
+serving_loop = None
 
 
 def create_markdown_block(text):
@@ -50,6 +145,13 @@ def create_markdown_block(text):
 help_text = create_markdown_block(
     f"`{command_string} list`: list all Pis.\n"
     f"\n"
+    f"`{command_string} latency`: show the command round-trip latency of "
+    f"each Pi.\n"
+    f"\n"
+    f"`{command_string} history RPI-ID [days]`: show the uptime and the "
+    f"latest interface changes of the selected Pi over the last `days` days "
+    f"(default={HISTORY_DAYS}).\n"
+    f"\n"
     f"`{command_string} ping RPI-ID texts`: ping the selected Pi, which will "
     f"be replied with the same input texts.\n"
     f"\n"
@@ -73,7 +175,18 @@ help_text = create_markdown_block(
     f"`{command_string} update RPI-ID`: Run `pi-install.sh` script to update "
     f"the selected Pi.\n"
     f"\n"
-    f"`{command_string} reboot RPI-ID`: Reboot the selected Pi.")
+    f"`{command_string} reboot RPI-ID`: Reboot the selected Pi.\n"
+    f"\n"
+    f"Every command taking an `RPI-ID` except `history` can target several "
+    f"Pis at once and post one consolidated table of their replies:\n"
+    f"- `all`: every registered Pi, e.g. `{command_string} status all`\n"
+    f"- a comma list: `{command_string} reboot RPI-1,RPI-2`, spaces after "
+    f"the commas are allowed\n"
+    f"- a pattern with `*`, `?` or `[...]`: `{command_string} ping RPI-1* "
+    f"hello`\n"
+    f"Entries can be mixed, such as `RPI-1*,RPI-20`. Replies are gathered "
+    f"for {args.fanout_timeout}s, Pis without a reply are listed as timed "
+    f"out.")
 help_text.insert(0, {
     "type": "header",
     "text": {
@@ -83,26 +196,14 @@ help_text.insert(0, {
 })
 
 
-def send_slack_attachment(rpi_id, content, filename, title):
+def send_slack_attachment(rpi_id, file, filename, title):
     logging.info("Sending as %s, attachment filename: %s", rpi_id, filename)
     if args.experimental:
         # Quit without actually sending the message.
         return
 
-    try:
-        # Call the files.upload method using the WebClient
-        # Uploading files requires the `files:write` scope
-        result = app.client.files_upload(
-            channels=["C06TNJBSB52"],
-            content=content,
-            filename=filename,
-            filetype="text",
-            title=title
-        )
-        logging.info(result)
-
-    except Exception as e:
-        logging.error(f"Error uploading file: {e}")
+    # Uploading files requires the `files:write` scope
+    log_uploader.upload("C06TNJBSB52", file, filename, title)
 
 
 def send_slack_blocks(rpi_id, blocks):
@@ -111,17 +212,90 @@ def send_slack_blocks(rpi_id, blocks):
         # Quit without actually sending the message.
         return
 
-    try:
-        # Call the chat.postMessage method using the WebClient
-        result = app.client.chat_postMessage(
-            channel="C06TNJBSB52",
-            blocks=blocks,
-            username=rpi_id
-        )
-        logging.info(result)
+    # Queue the chat.postMessage call, replies to the channel are posted in
+    # order with backoff on rate limits
+    reply_sender.send("C06TNJBSB52", blocks, username=rpi_id)
+
+
+def format_freshness(since):
+    if since is None:
+        return "never"
+    seconds = int((datetime.now(timezone.utc) - since).total_seconds())
+    if seconds < 60:
+        return f"{seconds}s ago"
+    return f"{pi_monitor.format_minutes_to_human_readable(seconds // 60)} ago"
 
-    except Exception as e:
-        logging.error(f"Error posting message: {e}")
+
+def fleet_reports():
+    """
+    Build the pi-monitor report rows from the in-memory fleet status.
+
+    Returns:
+        A list of report rows, or None if no status was received yet.
+    """
+    rpi_ids = firebase.get_rpi_ids()
+    with fleet_lock:
+        if not fleet_status:
+            return None
+        return pi_monitor.build_reports(fleet_status, rpi_ids)
+
+
+def update_fleet_status(msg):
+    global fleet_updated
+    pi_mac = payloads.topic_mac(msg.topic)
+    try:
+        retained_msg = payloads.decode(msg, payloads.STATUS)
+        status = pi_monitor.parse_status(retained_msg)
+    except (payloads.PayloadError, KeyError, TypeError, ValueError,
+            AttributeError) as e:
+        logging.error("Cannot parse status of %s: %s", pi_mac, e)
+        metrics.MQTT_DISCARDED.inc(tool="cmd-monitor", reason="parse")
+        return
+    with fleet_lock:
+        fleet_status.update(pi_mac, retained_msg["mac"], *status)
+        fleet_updated = datetime.now(timezone.utc)
+    if history is not None:
+        history.append(pi_mac, *status)
+
+
+def format_history(rpi_id, rpi_mac, days):
+    """
+    Summarize the status history of a Pi over the last `days` days.
+    """
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    summary = history.uptime(rpi_mac, since)
+    if summary is None:
+        return f"No status report of {rpi_id} in the last {days} days"
+    changes = history.transitions(rpi_mac, since)
+    lines = [
+        f"{rpi_id}: {summary['samples']} reports in the last {days} days",
+        f"ETH up {summary['eth']:.1%}, WIFI up {summary['wlan']:.1%}",
+        f"{len(changes)} interface changes, ETH last went down "
+        f"{format_freshness(history.last_down(rpi_mac, 'eth'))}",
+    ]
+    for time_changed, iface, is_up in changes[-HISTORY_CHANGES:]:
+        lines.append(f"{time_changed:%Y-%m-%d %H:%M} UTC {iface.upper()} "
+                     f"{'UP' if is_up else 'DOWN'}")
+    return "\n".join(lines)
+
+
+async def respond_history(respond, rpi_id, extras):
+    if history is None:
+        await respond("Error: the status history is disabled!")
+        return
+    rpi_mac = firebase.get_mac_from_rpi_id(rpi_id)
+    if rpi_mac is None:
+        logging.warning("Invalid Pi ID: %s", rpi_id)
+        await respond(f"Error: {rpi_id} is invalid!")
+        return
+    try:
+        days = int(extras) if extras else HISTORY_DAYS
+    except ValueError:
+        await respond(f"Error: {extras} is not a number of days!")
+        return
+    # The SQLite queries block, keep them off the event loop
+    text = await asyncio.to_thread(format_history, rpi_id, rpi_mac, days)
+    await respond(f"```{text}```")
 
 
 def print_indent(count):
@@ -152,77 +326,297 @@ def dict_to_string(dict_obj, indent=0):
 def respond_cmd(ack, respond, command):
     logging.debug("Command: %s", command)
     ack()
+
+    async def respond_async(*args, **kwargs):
+        return respond(*args, **kwargs)
+
+    asyncio.run(handle_command(respond_async, command))
+
+
+async def handle_command(respond, command):
+    """
+    Run a slash command once acknowledged. Waits for the broker and the
+    collection are awaited so that commands share the event loop.
+
+    Args:
+        respond: Asynchronous Bolt `respond`.
+        command (dict): The Slack command payload.
+    """
+    if cluster_node is not None and not await cluster_node.claim(
+            command.get("trigger_id")):
+        return
     # Parse request body data
-    splits = command["text"].split(" ", 2)
-    cmd = splits[0]
+    cmd, _, args_text = command["text"].strip().partition(" ")
     if cmd == "help":
-        respond(blocks=help_text)
+        await respond(blocks=help_text)
         return
     elif cmd == "list":
-        respond("Listing all Pis...")
-        pi_monitor.main(args.experimental)
+        reports = fleet_reports()
+        if reports is None:
+            # Status cache not populated yet, poll the broker instead
+            await respond("Listing all Pis...")
+            collector = pi_monitor.FleetCollector(firebase.get_rpi_ids())
+            reports = await collector.run_async(client)
+        else:
+            await respond(
+                f"Listing all Pis from status cache: {len(reports)} "
+                f"devices, last update {format_freshness(fleet_updated)}, "
+                f"subscribed {format_freshness(fleet_since)}...")
+        pi_monitor.publish_reports(reports, args.experimental)
+        return
+    elif cmd == "latency":
+        table = pending_requests.create_latency_table()
+        await respond(f"```{table.get_string()}```")
+        return
+
+    rpi_id, extras = fanout.split_spec(args_text)
+    if cmd == "history":
+        await respond_history(respond, rpi_id, extras)
+        return
+    if fanout.is_fanout(rpi_id):
+        await respond_fanout(respond, cmd, rpi_id, extras)
         return
 
-    rpi_id = splits[1]
     rpi_mac = firebase.get_mac_from_rpi_id(rpi_id)
-    extras = splits[2] if len(splits) > 2 else ""
 
     if rpi_mac is None:
         logging.warning("Invalid Pi ID: %s", rpi_id)
-        respond(f"Error: {rpi_id} is invalid!")
+        await respond(f"Error: {rpi_id} is invalid!")
         return
 
     # Immediately reply to give acknowledgment
-    respond(f"Sending {cmd} command to {rpi_id}...")
-
+    await respond(f"Sending {cmd} command to {rpi_id}...")
+    publish_cmd(rpi_mac, rpi_id, cmd, extras)
+
+
+def command_type(cmd, extras):
+    """
+    Return the command topic suffix, which the Pi echoes as reply type.
+    """
+    if cmd != "ping" and extras:
+        cmd = f"{cmd}/{extras.replace(' ', '/')}"
+    return cmd
+
+
+def publish_cmd(rpi_mac, rpi_id, cmd, extras, notify=True):
+    """
+    Publish a command to a Pi and wait for its reply in the pending table.
+
+    Args:
+        notify (bool): Post to Slack if the Pi does not reply in time.
+    """
+    cmd_type = command_type(cmd, extras)
+    corr_id = pending_requests.add(rpi_mac, rpi_id, cmd_type, notify=notify)
+    if cluster_node is not None:
+        # Replies without correlation ID must come back to this node
+        cluster_node.own(rpi_mac, pending.command_timeout(cmd_type))
+    topic = f"Schmidt/{rpi_mac}/config/{cmd_type}"
     if cmd == "ping":
-        topic = f"Schmidt/{rpi_mac}/config/{cmd}"
+        # The ping text is echoed back, the reply is matched by type
         logging.info("Publishing to topic %s, message %s", topic, extras)
         client.publish(topic, extras, qos=1)
     else:
-        if extras:
-            cmd = f"{cmd}/{extras.replace(' ', '/')}"
-        topic = f"Schmidt/{rpi_mac}/config/{cmd}"
-        logging.info("Publishing to topic %s", topic)
-        client.publish(topic, "", qos=1)
+        request = {"id": corr_id}
+        if cmd == "logs":
+            # Let the Pi opt in to compressed and chunked log replies
+            request["accept"] = log_transfer.capability(max_log_bytes)
+        payload = json.dumps(request)
+        logging.info("Publishing to topic %s, message %s", topic, payload)
+        client.publish(topic, payload, qos=1)
+
+
+def notify_timeout(request):
+    logging.warning("No reply from %s to %s", request.rpi_id,
+                    request.cmd_type)
+    send_slack_blocks(request.rpi_id, create_markdown_block(
+        f"```No reply from {request.rpi_id} to {request.cmd_type} after "
+        f"{round(request.deadline - request.sent_at)}s```"))
+
+
+# Membership in a group of nodes sharing the replies, None when alone
+cluster_node = cluster.Cluster(args.group, node_id) if args.group else None
+pending_requests = pending.PendingRequests(
+    notify_timeout, cluster_node.id_prefix() if cluster_node else "")
+log_assembler = log_transfer.TransferAssembler(max_bytes=max_log_bytes)
+
+
+async def respond_fanout(respond, cmd, spec, extras):
+    targets, unknown = fanout.resolve_targets(spec, firebase.get_rpi_ids())
+    if unknown:
+        logging.warning("Invalid Pi IDs: %s", unknown)
+        await respond(f"Error: {', '.join(unknown)} matched no Pi!")
+        return
+    if not targets:
+        await respond(f"Error: {spec} matched no Pi!")
+        return
+
+    await respond(f"Sending {cmd} command to {len(targets)} Pis, gathering "
+                  f"replies for {args.fanout_timeout}s...")
+    # Register before publishing so that no early reply is missed
+    fan = fanout.FanOut(command_type(cmd, extras), targets, finish_fanout,
+                        args.fanout_timeout)
+    with fanouts_lock:
+        fanouts.append(fan)
+    for target_id, rpi_mac in targets.items():
+        # The fan-out table reports the devices that timed out
+        publish_cmd(rpi_mac, target_id, cmd, extras, notify=False)
+    # The timeout runs on the serving loop, there is none with the threaded
+    # runtime where each command has its own short-lived loop
+    fan.start(serving_loop)
+
+
+def finish_fanout(fan):
+    with fanouts_lock:
+        fanouts.remove(fan)
+    ok, failed, timed_out = fan.counts()
+    send_slack_blocks("fleet", create_markdown_block(
+        f"`{fan.cmd_type}` sent to {len(fan.targets)} Pis: {ok} ok, "
+        f"{failed} failed, {timed_out} timed out"))
+    for page in fan.pages():
+        send_slack_blocks("fleet", create_markdown_block(f"```{page}```"))
 
 
 def on_connect(client, userdata, flags, rc):
+    global fleet_since
     if rc == 0:
         logging.info("Connected to MQTT broker")
         # Subscribe for commands replies
-        client.subscribe(topic_report_conf)
+        if cluster_node is not None:
+            cluster_node.subscribe(client, topic_report_conf)
+        else:
+            client.subscribe(topic_report_conf)
+        # Subscribe for device status to keep the fleet cache up to date
+        client.subscribe(topic_report_status, qos=1)
+        fleet_since = datetime.now(timezone.utc)
     else:
         logging.error(f"Connection failed with code {rc}")
 
 
 def on_message(client, userdata, msg):
+    if cluster_node is not None:
+        msg = cluster_node.receive(msg)
+        if msg is None:
+            return
     topic = msg.topic
-    msg_str = msg.payload.decode("utf-8")
-    logging.info("Message received: %s, %s", topic, msg_str)
+    if topic.endswith("/report/status"):
+        metrics.MQTT_RECEIVED.inc(tool="cmd-monitor", topic="status")
+        logging.debug("Status received: %s", topic)
+        with metrics.MESSAGE_SECONDS.time(tool="cmd-monitor", type="status"):
+            update_fleet_status(msg)
+        # Feed any pi-monitor collection running on this client
+        pi_monitor.dispatch(client, userdata, msg)
+        return
+
+    metrics.MQTT_RECEIVED.inc(tool="cmd-monitor", topic="config")
+
+    # Leave paho's network thread free, replies of one device are handled
+    # in order by the same worker
+    reply_dispatcher.submit(topic.split("/")[1], msg)
+    logging.debug("Reply queue depth: %s", reply_dispatcher.depth())
+
 
-    # Try parse payload as JSON
+def handle_reply(msg):
+    start = time.perf_counter()
+    msg_type = process_reply(msg)
+    metrics.MESSAGE_SECONDS.observe(time.perf_counter() - start,
+                                    tool="cmd-monitor",
+                                    type=msg_type or "discarded")
+
+
+def discard(reason):
+    metrics.MQTT_DISCARDED.inc(tool="cmd-monitor", reason=reason)
+
+
+def process_reply(msg):
+    """
+    Handle a command reply.
+
+    Returns:
+        The reply command (first level of its type), or None if discarded.
+    """
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info("Message received: %s, %s", msg.topic,
+                     msg.payload.decode("utf-8", errors="replace"))
+
+    # Parse and check the payload, payloads posted more than 10 minutes ago
+    # are discarded before parsing
     try:
-        msg_payload = json.loads(msg_str)
-    except Exception:
-        logging.error("Cannot parse payload %s", msg_str)
+        msg_payload = payloads.decode(msg, payloads.REPLY,
+                                      max_age_sec=REPLY_MAX_AGE_SEC)
+    except payloads.PayloadError as e:
+        if e.reason == "stale":
+            logging.info("Discarding %s", e)
+        else:
+            logging.error("Cannot decode payload on %s: %s", msg.topic, e)
+        discard(e.reason)
         return
 
-    # Check payload parameters
-    for param in ["mac", "timestamp", "type", "result", "out", "err"]:
-        if param not in msg_payload:
-            logging.error("%s not in MQTT payload!", param)
-            return
+    # Replies to the commands of another node of the group go to that node
+    if cluster_node is not None and cluster_node.forward(
+            msg, msg_payload.get("id")):
+        return "forwarded"
+
+    # Logs are decoded to a spool file, long ones are uploaded from it and
+    # only a preview is kept in the payload
+    spool = None
+    if (msg_payload["type"].startswith("logs")
+            and msg_payload["result"] == "success"):
+        try:
+            if "transfer_id" in msg_payload:
+                spooled = log_assembler.add(msg_payload["mac"], msg_payload)
+                if spooled is None:
+                    # Wait for the remaining parts
+                    return "logs-part"
+            else:
+                spooled = log_transfer.spool_log(msg_payload["out"],
+                                                 max_log_bytes)
+            spool, size = spooled
+            if size <= INLINE_LOG_CHARS:
+                log = spool.read().decode("utf-8", errors="replace")
+                spool.close()
+                spool = None
+            else:
+                log = spool.read(LOG_PREVIEW_CHARS).decode(
+                    "utf-8", errors="replace") + "..."
+                spool.seek(0)
+            msg_payload["out"] = dict(msg_payload["out"], log=log,
+                                      size=size, encoding="plain")
+        except (log_transfer.TransferError, KeyError, ValueError) as e:
+            logging.error("Cannot assemble log from %s: %s",
+                          msg_payload["mac"], e)
+            msg_payload["result"] = "error"
+            msg_payload["err"] = str(e)
 
-    # Check if payload is outdated
-    span = abs(datetime.now(timezone.utc) - datetime.fromisoformat(
-        msg_payload["timestamp"]))
-    logging.debug("span: %d s", span.seconds)
-    # Check if payload is posted more than 10 minutes ago
-    if span.seconds > 600:
-        logging.info("Discarding old payload with timestamp %s",
-                     msg_payload["timestamp"])
-        return
+    try:
+        return respond_reply(msg_payload, spool)
+    finally:
+        if spool is not None:
+            spool.close()
+
+
+def respond_reply(msg_payload, spool):
+    """
+    Match a checked reply to its request and answer it on Slack.
+
+    Args:
+        spool: Binary file holding a long decoded log, None otherwise.
+    """
+    resolved = pending_requests.resolve(
+        msg_payload["mac"], msg_payload["type"], msg_payload.get("id"))
+    if resolved is not None:
+        request, latency = resolved
+        logging.info("Reply from %s to %s after %.2fs", request.rpi_id,
+                     request.cmd_type, latency)
+    else:
+        logging.info("Unsolicited or late %s reply from %s",
+                     msg_payload["type"], msg_payload["mac"])
+
+    # Replies to a fan-out command go to its consolidated table instead
+    with fanouts_lock:
+        active = list(fanouts)
+    for fan in active:
+        if fan.capture(msg_payload["mac"], msg_payload):
+            return "fanout"
 
     rpi_id = firebase.get_rpi_id_from_mac(msg_payload["mac"])
     match msg_payload["type"]:
@@ -265,8 +659,8 @@ def on_message(client, userdata, msg):
                     title = f"{rpi_id} log"
                 content = msg_payload["out"]["log"]
 
-                if len(content) > 3000:
-                    send_slack_attachment(rpi_id, content, filename, title)
+                if spool is not None:
+                    send_slack_attachment(rpi_id, spool, filename, title)
                 else:
                     text = f"{title}\n```{content}```"
                     slack_block = create_markdown_block(text)
@@ -333,28 +727,89 @@ def on_message(client, userdata, msg):
             slack_block = create_markdown_block(text)
             send_slack_blocks(rpi_id, slack_block)
 
+    return msg_payload["type"].split("/")[0]
+
+
+reply_dispatcher = dispatcher.PartitionedDispatcher(
+    handle_reply, args.workers, args.queue_size, args.drop_policy,
+    name="reply")
+
+
+def run_async():
+    """
+    Serve Slack and MQTT on one event loop until interrupted.
+    """
+    from slack_bolt.async_app import AsyncApp
+
+    async_app = AsyncApp(
+        token=slack_conf["bot_token"],
+        signing_secret=slack_conf["signing_secret"]
+    )
+
+    @async_app.command(command_string)
+    async def respond_cmd_async(ack, respond, command):
+        logging.debug("Command: %s", command)
+        await ack()
+        await handle_command(respond, command)
+
+    async def serve():
+        global client, serving_loop
+        serving_loop = asyncio.get_running_loop()
+        client = async_runtime.create_mqtt_client(mqtt_conf, client_id)
+        runner = await async_runtime.serve_slack(
+            async_app, int(slack_conf["slack_port"]))
+        try:
+            await async_runtime.run_mqtt(client, on_connect, on_message)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(serve())
+
 
 if __name__ == '__main__':
 
-    client = mqtt.Client(
-        client_id=client_id,
-        callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
-    client.on_connect = on_connect
-    client.on_message = on_message
+    # Serve from the registry snapshot, then keep it fresh through a listen
+    # stream for the lifetime of the process
+    firebase.registry.warm_start(reconcile=False)
+    firebase.registry.start_listener()
 
-    client.username_pw_set(mqtt_conf['username'], mqtt_conf['password'])
-    client.connect(mqtt_conf['broker_addr'],
-                   int(mqtt_conf['broker_port']),
-                   60)
-    client.loop_start()
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+        logging.info("Serving metrics on port %d", args.metrics_port)
 
     try:
-        app.start(port=int(slack_conf["slack_port"]))
+        if args.async_runtime:
+            run_async()
+        else:
+            client = mqtt.Client(
+                client_id=client_id,
+                callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
+            client.on_connect = on_connect
+            client.on_message = on_message
+
+            client.username_pw_set(mqtt_conf['username'],
+                                   mqtt_conf['password'])
+            client.connect(mqtt_conf['broker_addr'],
+                           int(mqtt_conf['broker_port']),
+                           60)
+            client.loop_start()
+            app.start(port=int(slack_conf["slack_port"]))
 
     except KeyboardInterrupt:
         print("\nKeyboard interrupt !")
 
     finally:
-        print("Disconnecting from the broker ...")
-        client.disconnect()
-        client.loop_stop()
+        if not args.async_runtime:
+            print("Disconnecting from the broker ...")
+            client.disconnect()
+            client.loop_stop()
+        logging.info("Registry stats: %s", firebase.registry.stats())
+        logging.info("Slack sender stats: %s", reply_sender.stats())
+        logging.info("Log uploader stats: %s", log_uploader.stats())
+        logging.info("Reply dispatcher stats: %s", reply_dispatcher.stats())
+        logging.info("Pending requests: %d", pending_requests.depth())
+        if cluster_node is not None:
+            logging.info("Cluster stats: %s", cluster_node.stats())
+        if history is not None:
+            history.close()
+        firebase.registry.stop_listener()
@@ -1,10 +1,23 @@
-import requests
 import json
 from prettytable import PrettyTable
-from datetime import datetime, timedelta, timezone
-from zoneinfo import ZoneInfo
 import math
+import time
 import argparse
+from slack_table import paginate_table
+import slack_sender
+import durations
+import firebase
+import changes
+
+# Characters read from the device file at once
+READ_CHUNK = 64 * 1024
+RECORD_SEPARATORS = " \t\r\n,[]"
+TABLE_FIELD_NAMES = ['RPI_ID', 'UP', 'LAST_HB', 'LAST_TEST_ETH',
+                     'LAST_TEST_WLAN', '#DAY', '#WEEK', 'CAP']
+# Columns of the last_timestamp, last_test_eth and last_test_wlan ages
+TIME_COLUMNS = (2, 3, 4)
+# Per-device states of the last change-only report
+CHANGES_PATH = ".device-status-states.json"
 
 
 def load_config():
@@ -14,33 +27,55 @@ def load_config():
     return devlist
 
 
-# Get the last device data from the server as a json object
-def get_last_data(fpath):
+# Stream the last device data exported from the server, record by record.
+# The export is a JSON array of records, or one JSON record per line. A bad
+# export exits the program, so that no partial table is posted or saved.
+def iter_records(fpath):
+    decoder = json.JSONDecoder()
     try:
-        # Attempt to open and load the JSON data
         with open(fpath, 'r') as file:
-            last_data = json.load(file)
+            buffer = ""
+            pos = 0
+            eof = False
+            while True:
+                # Skip the array brackets and separators between records
+                while pos < len(buffer) and buffer[pos] in RECORD_SEPARATORS:
+                    pos += 1
+                if pos == len(buffer):
+                    if eof:
+                        return
+                    buffer = file.read(READ_CHUNK)
+                    pos = 0
+                    eof = not buffer
+                    continue
+                try:
+                    record, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    # The record spans past the buffer, read more of it
+                    chunk = file.read(max(READ_CHUNK, len(buffer)))
+                    eof = not chunk
+                    buffer = buffer[pos:] + chunk
+                    pos = 0
+                    continue
+                yield record
     except FileNotFoundError:
         # Handle missing file error
         print(f"Error: The file '{fpath}' does not exist.")
+        raise SystemExit(1)
     except json.JSONDecodeError:
         # Handle errors in JSON decoding
         print(f"Error: The file '{fpath}' contains invalid JSON.")
+        raise SystemExit(1)
     except Exception as e:
         # Handle other possible exceptions (e.g., permission errors)
         print(f"An unexpected error occurred: {e}")
-    return last_data
+        raise SystemExit(1)
 
 
-def load_slack_config():
-    with open('.slack-config.json', 'r') as file:
-        cf = json.load(file)
-    return cf
-
-
-# This function takes table as input and converts it into string
-def send_slack_msg(input_table):
-    table = input_table.get_string()
+# This function takes a rendered table string as input
+def send_slack_msg(table):
     payload = {
         "blocks": [
             {
@@ -52,132 +87,152 @@ def send_slack_msg(input_table):
             }
         ]
     }
-    slack_conf = load_slack_config()
-    requests.post(slack_conf['url'], json=payload)
-
-
-def ms_to_iso(timestamp_ms):
-    if isinstance(timestamp_ms, float) and math.isnan(timestamp_ms):
-        return 'NaN'
-    else:
-        # Convert milliseconds to seconds
-        timestamp_seconds = timestamp_ms / 1000.0
-
-        # Convert timestamp to a datetime object
-        dt = datetime.fromtimestamp(timestamp_seconds, timezone.utc)
-
-        # Convert datetime to ISO format
-        iso_format = dt.isoformat()
-
-    return iso_format
-
-
-# Calculate the time difference given ISO format times with timezones as a string
-def calculate_iso_difference(time_str1, time_str2):
-    # Convert strings to datetime objects, ensuring they are timezone aware
-    time1 = datetime.fromisoformat(time_str1)
-    time2 = datetime.fromisoformat(time_str2)
-
-    # Convert both times to the same timezone (UTC) for comparison
-    time1_utc = time1.astimezone(ZoneInfo('UTC'))
-    time2_utc = time2.astimezone(ZoneInfo('UTC'))
-
-    # Calculate the difference
-    time_diff = time1_utc - time2_utc
-    time_diff = time_diff.total_seconds()
-    # Return total seconds
-    return time_diff
-
-
-def calculate_age(data):
-    current_time = datetime.now(timezone.utc).astimezone().isoformat()
-    time_keys = ['last_timestamp', 'last_test_eth', 'last_test_wlan']
-
-    for item in data:
-        for key in time_keys:
-            timestamp_str = item.get(key)
-            if timestamp_str and timestamp_str != 'NaN':
-                timestamp_dt = ms_to_iso(timestamp_str)
-                age_delta = calculate_iso_difference(
-                    current_time, timestamp_dt)
-                age_suffix = "mins"
-                age_str = int(age_delta / 60.0)     # minutes
-                if age_str > 120:
-                    age_str = int(age_str / 60.0)     # hours
-                    age_suffix = "hrs"
-                if age_str > 48:
-                    age_str = int(age_str / 24.0)     # days
-                    age_suffix = "days"
-                item[key] = f"{age_str} {age_suffix} ago"
-            elif timestamp_str == 'NaN':
-                item[key] = 'N/A'
-    return data
+    slack_sender.send_webhook_blocks(payload["blocks"])
+
+
+def format_ages(column, now_ms):
+    """
+    Format a column of epoch millisecond timestamps as ages.
+
+    Args:
+        column (list): Timestamps in milliseconds, NaN or 'NaN' when
+            unknown.
+        now_ms (float): Reference time in milliseconds.
+
+    Returns:
+        A list of age strings, in the column order.
+    """
+    # Ages repeat a lot across devices, format each one once
+    labels = dict()
+    ages = []
+    for timestamp_ms in column:
+        if timestamp_ms == 'NaN' or (isinstance(timestamp_ms, float)
+                                     and math.isnan(timestamp_ms)):
+            ages.append('N/A')
+        elif not timestamp_ms:
+            ages.append(timestamp_ms)
+        else:
+            minutes = int((now_ms - timestamp_ms) / 60000.0)
+            label = labels.get(minutes)
+            if label is None:
+                label = labels[minutes] = (
+                    durations.format_minutes(minutes, durations.DEVICE_UNITS)
+                    + " ago")
+            ages.append(label)
+    return ages
+
+
+# Build the table row of one device record, ages are formatted afterwards
+def create_row(rpi_identifier, item):
+    return [rpi_identifier,
+            "YES" if item["online"] else "NO",
+            item.get('last_timestamp'),
+            item.get('last_test_eth'),
+            item.get('last_test_wlan'),
+            item['total_day'],
+            item['total_consecutive_week'],
+            "YES" if item["data_used_gbytes"] > 100 else "NO"]
 
 
 # Main function
-def main(device_file_path):
-    # Create a list of dictionaries (LoD) from the json file
-    device_list = get_last_data(device_file_path)
-    pi_dict = [load_config()]
-    # Convert dictionary to a JSON object
-    # pi_dev = [json.dumps(pi_dict, indent=4)]
-    # print(pi_dev)
-    # Flatten the dictionary inside the device dictionary for easier access
-    lookup = {v: k for d in pi_dict for k, v in d.items()}
-
-    # Add the appropriate RPI identifier to each entry in device_list
-    augmented_list = []
-    for item in device_list:
-        mac_address = item['mac']
-        rpi_identifier = lookup.get(mac_address)
+def main(records, lookup, changes_only=False):
+    """
+    Print the device table and send it to Slack.
+
+    Args:
+        records (iterable): Device records, consumed one by one.
+        lookup (dict): MAC: RPI identifier.
+        changes_only (bool): Only show the devices whose UP or CAP state
+            changed since the last change-only run.
+    """
+    # Join each record against the lookup as it is read, only the rows of
+    # the known devices are kept
+    rows = []
+    for item in records:
+        rpi_identifier = lookup.get(item.get('mac'))
         if rpi_identifier:
-            # Create a new dictionary starting with the RPI_ID
-            new_item = {'RPI_ID': rpi_identifier}
-            # Merge in the rest of the data from the original item
-            new_item.update(item)
-            # Append the new item to the filtered list
-            augmented_list.append(new_item)
-    # print(augmented_list)
-    updated_data = calculate_age(augmented_list)
+            rows.append(create_row(rpi_identifier, item))
+    rows.sort(key=lambda row: row[0])
+
+    title = "DATA FROM FIREBASE"
+    if changes_only:
+        states = {row[0]: [row[1], row[7]] for row in rows}
+        # A dry run leaves the snapshot for the next real run
+        previous, diff = changes.track_changes(
+            states, CHANGES_PATH, save=not args.experimental)
+        # On the first run, the full table is the baseline
+        if previous is not None:
+            changed, added, removed = diff
+            text = changes.summary(len(states), changed, added, removed)
+            print(text)
+            if not args.experimental:
+                slack_sender.send_webhook_blocks([{
+                    "type": "section",
+                    "text": {"type": "mrkdwn", "text": text}
+                }])
+            shown = set(changed) | set(added)
+            rows = [row for row in rows if row[0] in shown]
+            for row in rows:
+                old = previous.get(row[0], [None, None])
+                row[1] = changes.mark_change(old[0], row[1])
+                row[7] = changes.mark_change(old[1], row[7])
+            title = "CHANGES SINCE THE LAST RUN"
+            if not rows:
+                slack_sender.webhook_sender().flush()
+                return
+
+    # Replace the timestamps with ages, one column at a time
+    now_ms = time.time() * 1000
+    for index in TIME_COLUMNS:
+        column = format_ages([row[index] for row in rows], now_ms)
+        for row, age in zip(rows, column):
+            row[index] = age
 
     # Define and print the new table with age strings
     table = PrettyTable()
-    table.field_names = ['RPI_ID', 'UP', 'LAST_HB', 'LAST_TEST_ETH',
-                         'LAST_TEST_WLAN', '#DAY', '#WEEK', 'CAP']
-    table.title = "DATA FROM FIREBASE"
-    updated_data = sorted(updated_data, key=lambda x: x["RPI_ID"])
-    for item in updated_data:
-        table.add_row(
-            [item['RPI_ID'],
-             "YES" if item["online"] else "NO",
-             item['last_timestamp'],
-             item['last_test_eth'],
-             item['last_test_wlan'],
-             item['total_day'],
-             item['total_consecutive_week'],
-             "YES" if item["data_used_gbytes"] > 100 else "NO"])
-        if len(table.get_string()) > 2800:
-            # Split data due to Slack 3000-characters limit
-            print(table)
-            if not args.experimental:
-                send_slack_msg(table)
-            table.clear_rows()
+    table.field_names = TABLE_FIELD_NAMES
+    table.title = title
+    table.add_rows(rows)
 
-    print(table)
-    if not args.experimental:
-        send_slack_msg(table)
+    # Split data due to Slack 3000-characters limit
+    for page in paginate_table(table, keep_empty=True):
+        print(page)
+        if not args.experimental:
+            send_slack_msg(page)
+    # Wait for the queued Slack messages to be delivered
+    slack_sender.webhook_sender().flush()
 
 
 if __name__ == "__main__":
     # Create an ArgumentParser object
     parser = argparse.ArgumentParser(description='Receive an input file.')
     # Expected argument
-    parser.add_argument('input_file', type=str,
+    parser.add_argument('input_file', type=str, nargs='?',
                         help='The path to the device file')
     parser.add_argument("--experimental", action="store_true",
                         help="Enable experimental mode")
+    parser.add_argument("--from-firebase", action="store_true",
+                        help=("Read the devices from Firebase instead of a "
+                              "file, only fetching the records changed since "
+                              "the last run"))
+    parser.add_argument("--full-sync", action="store_true",
+                        help="With --from-firebase, reload every record")
+    parser.add_argument("--changes-only", action="store_true",
+                        help=("Only report the devices whose UP or CAP state "
+                              "changed since the last --changes-only run"))
     # Parse the arguments
     args = parser.parse_args()
-    # Use the input file
-    device_file_path = args.input_file
-    main(device_file_path)
+    if args.from_firebase:
+        rpi_ids = firebase.get_rpi_ids()
+        # Registry MACs use dashes, accept records with either separator
+        lookup = {mac.replace("-", ":"): rpi_id
+                  for mac, rpi_id in rpi_ids.items()}
+        lookup.update(rpi_ids)
+        main(firebase.sync_devices(full=args.full_sync).values(), lookup,
+             args.changes_only)
+    elif args.input_file:
+        # Use the input file, with the RPI identifiers of .rpi-config.json
+        main(iter_records(args.input_file),
+             {v: k for k, v in load_config().items()}, args.changes_only)
+    else:
+        parser.error("an input file or --from-firebase is required")
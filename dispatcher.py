@@ -0,0 +1,129 @@
+import logging
+import queue
+import threading
+import zlib
+
+# What to do with a message when its partition queue is full
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+BLOCK = "block"
+POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+# Longest time a BLOCK submit may stall the caller before dropping
+BLOCK_TIMEOUT_SEC = 5.0
+
+
+class PartitionedDispatcher:
+    """
+    Hand messages to a bounded pool of worker threads.
+
+    Messages are partitioned by key, so messages sharing a key (a device MAC)
+    are handled in order by the same worker while different keys are handled
+    in parallel. Each worker has its own bounded queue, and `policy` decides
+    what happens when it is full.
+    """
+
+    def __init__(self, handler, workers=4, max_queue=1000,
+                 policy=DROP_OLDEST, name="dispatcher"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown drop policy {policy}")
+        if workers < 1:
+            raise ValueError(f"Need at least 1 worker, got {workers}")
+        if max_queue < 1:
+            # A Queue of maxsize 0 would be unbounded
+            raise ValueError(f"Need a queue size of at least 1, got "
+                             f"{max_queue}")
+        self.handler = handler
+        self.policy = policy
+        self.name = name
+        self.submitted = 0
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._queues = [queue.Queue(maxsize=max_queue)
+                        for i in range(workers)]
+        for i, partition in enumerate(self._queues):
+            threading.Thread(target=self._worker, args=(partition,),
+                             name=f"{name}-{i}", daemon=True).start()
+
+    def _partition(self, key):
+        # crc32 rather than hash() to keep partitions stable across runs
+        return self._queues[zlib.crc32(key.encode()) % len(self._queues)]
+
+    def _drop(self, key):
+        with self._lock:
+            self.dropped += 1
+        logging.warning("%s: queue full, dropping message for %s",
+                        self.name, key)
+
+    def submit(self, key, *args):
+        """
+        Queue `handler(*args)` on the worker owning `key`.
+
+        Returns:
+            True if the message was queued.
+        """
+        partition = self._partition(key)
+        with self._lock:
+            self.submitted += 1
+        if self.policy == BLOCK:
+            try:
+                partition.put(args, timeout=BLOCK_TIMEOUT_SEC)
+                return True
+            except queue.Full:
+                self._drop(key)
+                return False
+        while True:
+            try:
+                partition.put_nowait(args)
+                return True
+            except queue.Full:
+                if self.policy == DROP_NEWEST:
+                    self._drop(key)
+                    return False
+            # DROP_OLDEST: make room and try again
+            try:
+                partition.get_nowait()
+                partition.task_done()
+                self._drop(key)
+            except queue.Empty:
+                pass
+
+    def _worker(self, partition):
+        while True:
+            args = partition.get()
+            try:
+                self.handler(*args)
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                logging.exception("%s: error handling message", self.name)
+            finally:
+                with self._lock:
+                    self.handled += 1
+                partition.task_done()
+
+    def depth(self):
+        """
+        Return the number of queued messages per worker.
+        """
+        return [partition.qsize() for partition in self._queues]
+
+    def join(self):
+        """
+        Block until every queued message has been handled.
+        """
+        for partition in self._queues:
+            partition.join()
+
+    def stats(self):
+        depth = self.depth()
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "handled": self.handled,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "depth": sum(depth),
+                "max_depth": max(depth),
+            }
@@ -0,0 +1,43 @@
+# Human-readable durations shared by the monitors
+#
+# A unit table lists (minimum minutes, minutes per unit, singular, plural)
+# from the largest unit down. A duration is shown in the first unit whose
+# minimum it reaches, truncated to a whole number of units.
+MINUTES_IN_HOUR = 60
+MINUTES_IN_DAY = MINUTES_IN_HOUR * 24
+MINUTES_IN_WEEK = MINUTES_IN_DAY * 7
+# Approximating a month as 30 days for simplicity
+MINUTES_IN_MONTH = MINUTES_IN_DAY * 30
+
+# Units of the pi-monitor report table
+REPORT_UNITS = (
+    (MINUTES_IN_MONTH, MINUTES_IN_MONTH, "Mth", "Mths"),
+    (MINUTES_IN_WEEK, MINUTES_IN_WEEK, "wk", "wks"),
+    (MINUTES_IN_DAY, MINUTES_IN_DAY, "day", "days"),
+    (MINUTES_IN_HOUR, MINUTES_IN_HOUR, "hr", "hrs"),
+    (float("-inf"), 1, "min", "mins"),
+)
+# Units of the device-status table: minutes up to 2 hours, hours up to 2
+# days, then days
+DEVICE_UNITS = (
+    (49 * MINUTES_IN_HOUR, MINUTES_IN_DAY, "days", "days"),
+    (121, MINUTES_IN_HOUR, "hrs", "hrs"),
+    (float("-inf"), 1, "mins", "mins"),
+)
+
+
+def format_minutes(total_minutes, units=REPORT_UNITS):
+    """
+    Format a whole number of minutes with the largest fitting unit.
+
+    Args:
+        total_minutes (int): The duration in minutes.
+        units (tuple): Unit table, see the module comment.
+
+    Returns:
+        str: For instance "3 hrs".
+    """
+    for min_minutes, unit_minutes, singular, plural in units:
+        if total_minutes >= min_minutes:
+            count = int(total_minutes / unit_minutes)
+            return f"{count} {singular if count == 1 else plural}"
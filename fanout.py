@@ -0,0 +1,183 @@
+import fnmatch
+import json
+import threading
+
+from prettytable import PrettyTable
+
+from slack_table import paginate_table
+
+# Seconds to wait for the replies of a fan-out command
+FANOUT_TIMEOUT_SEC = 60
+# Longest output summary shown per device in the consolidated table
+SUMMARY_LENGTH = 60
+TABLE_FIELD_NAMES = ["RPI-ID", "MAC", "RESULT", "OUTPUT"]
+
+
+def is_fanout(spec):
+    """
+    Tell whether a target spec selects several Pis.
+
+    Args:
+        spec (string): `all`, a comma list or a glob pattern such as `RPI-1*`.
+    """
+    return spec == "all" or "," in spec or any(c in spec for c in "*?[")
+
+
+def split_spec(text):
+    """
+    Split the target spec off the arguments of a command.
+
+    A comma list may have spaces around its commas, such as
+    `RPI-1, RPI-2`, so tokens are consumed while the spec ends with a comma
+    or the next token starts with one.
+
+    Returns:
+        A (spec, extras) tuple.
+    """
+    spec, _, rest = text.strip().partition(" ")
+    rest = rest.lstrip()
+    while rest and (spec.endswith(",") or rest.startswith(",")):
+        token, _, rest = rest.partition(" ")
+        spec += token
+        rest = rest.lstrip()
+    return spec, rest
+
+
+def resolve_targets(spec, rpi_ids):
+    """
+    Resolve a target spec against the registry.
+
+    Args:
+        spec (string): `all`, comma separated RPI-IDs and glob patterns.
+        rpi_ids (dict): MAC: RPI-ID pairs.
+
+    Returns:
+        A ({RPI-ID: MAC}, [unknown entries]) tuple.
+    """
+    by_id = {rpi_id: mac for mac, rpi_id in rpi_ids.items()
+             if rpi_id.startswith("RPI-")}
+    targets = dict()
+    unknown = list()
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if entry == "all":
+            targets.update(by_id)
+        elif any(c in entry for c in "*?["):
+            matched = {rpi_id: mac for rpi_id, mac in by_id.items()
+                       if fnmatch.fnmatchcase(rpi_id, entry)}
+            if not matched:
+                unknown.append(entry)
+            targets.update(matched)
+        elif entry in by_id:
+            targets[entry] = by_id[entry]
+        else:
+            unknown.append(entry)
+    return targets, unknown
+
+
+def summarize(msg_payload):
+    """
+    Return a one-line summary of a command reply.
+    """
+    if msg_payload["result"] != "success":
+        text = json.dumps(msg_payload["err"])
+    else:
+        text = json.dumps(msg_payload["out"])
+    text = " ".join(text.split())
+    if len(text) > SUMMARY_LENGTH:
+        text = text[:SUMMARY_LENGTH - 3] + "..."
+    return text
+
+
+class FanOut:
+    """
+    Gather the replies of one command published to several Pis.
+
+    The command is done when every target replied or after `timeout_sec`,
+    then `on_done` is called once with this fan-out.
+    """
+
+    def __init__(self, cmd_type, targets, on_done,
+                 timeout_sec=FANOUT_TIMEOUT_SEC):
+        self.cmd_type = cmd_type
+        # MAC: RPI-ID of every target, and MAC: (result, summary) of replies
+        self.targets = {mac: rpi_id for rpi_id, mac in targets.items()}
+        self.results = dict()
+        self.on_done = on_done
+        self.timeout_sec = timeout_sec
+        self.done = False
+        self._lock = threading.Lock()
+        self._timer = None
+        self._loop = None
+
+    def start(self, loop=None):
+        """
+        Start the timeout, on `loop` instead of a timer thread when given,
+        from the thread running the loop.
+        """
+        with self._lock:
+            if self.done:
+                return
+            if loop is None:
+                self._timer = threading.Timer(self.timeout_sec, self.finish)
+                self._timer.daemon = True
+                self._timer.start()
+            else:
+                self._loop = loop
+                self._timer = loop.call_later(self.timeout_sec, self.finish)
+
+    def capture(self, mac, msg_payload):
+        """
+        Record a reply if it belongs to this fan-out.
+
+        Returns:
+            True if the reply was captured.
+        """
+        mac = mac.replace(":", "-")
+        with self._lock:
+            if (self.done or mac not in self.targets
+                    or msg_payload["type"] != self.cmd_type
+                    or mac in self.results):
+                return False
+            result = ("ok" if msg_payload["result"] == "success"
+                      else "failed")
+            self.results[mac] = (result, summarize(msg_payload))
+            complete = len(self.results) == len(self.targets)
+        if complete:
+            self.finish()
+        return True
+
+    def finish(self):
+        with self._lock:
+            if self.done:
+                return
+            self.done = True
+        if self._loop is not None:
+            # Loop handles are cancelled from the loop thread
+            self._loop.call_soon_threadsafe(self._timer.cancel)
+        elif self._timer is not None:
+            self._timer.cancel()
+        self.on_done(self)
+
+    def counts(self):
+        ok = sum(1 for result, _ in self.results.values() if result == "ok")
+        failed = len(self.results) - ok
+        return ok, failed, len(self.targets) - len(self.results)
+
+    def create_table(self):
+        table = PrettyTable()
+        table.field_names = TABLE_FIELD_NAMES
+        table.align["OUTPUT"] = "l"
+        for mac, rpi_id in sorted(self.targets.items(),
+                                  key=lambda item: item[1]):
+            result, summary = self.results.get(mac, ("timeout", ""))
+            table.add_row([rpi_id, mac, result, summary])
+        return table
+
+    def pages(self):
+        """
+        Yield the consolidated table split for Slack.
+        """
+        return paginate_table(self.create_table())
@@ -1,12 +1,320 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import db
 
-cred = credentials.Certificate(
-    "nd-schmidt-firebase-adminsdk-d1gei-43db929d8a.json")
-firebase_admin.initialize_app(cred, {
-    "databaseURL": "https://nd-schmidt-default-rtdb.firebaseio.com"
-})
+import metrics
+
+CERT_PATH = "nd-schmidt-firebase-adminsdk-d1gei-43db929d8a.json"
+DATABASE_URL = "https://nd-schmidt-default-rtdb.firebaseio.com"
+
+# Seconds before a registry without a live listener reloads the config node
+REGISTRY_TTL_SEC = 300
+# Last-known MAC: RPI-ID map, used to serve lookups before Firebase answers
+SNAPSHOT_PATH = ".rpi-registry.json"
+SNAPSHOT_VERSION = 1
+# Device records node and its local copy, synced by `last_timestamp`
+DEVICES_NODE = "devices"
+DEVICE_CACHE_PATH = ".device-cache.json"
+DEVICE_CACHE_VERSION = 1
+# Seconds between full reloads of the devices node, which catch deleted
+# records and records changed without a new `last_timestamp`
+DEVICE_FULL_SYNC_SEC = 7 * 24 * 3600
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def init_app():
+    """
+    Initialize the Firebase app on first use.
+
+    Reading the certificate and creating the app is deferred until the first
+    query so that importing this module stays cheap.
+    """
+    global _app
+    with _app_lock:
+        if _app is None:
+            cred = credentials.Certificate(CERT_PATH)
+            _app = firebase_admin.initialize_app(cred, {
+                "databaseURL": DATABASE_URL
+            })
+    return _app
+
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    """
+    Load the MAC: RPI-ID snapshot written by the last registry refresh.
+
+    Args:
+        path (string): Snapshot file path.
+
+    Returns:
+        A (rpi_ids, timestamp) tuple, or (None, None) if there is no usable
+        snapshot.
+    """
+    try:
+        with open(path, 'r') as file:
+            snapshot = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None, None
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None, None
+    return snapshot.get("rpi_ids", dict()), snapshot.get("timestamp")
+
+
+def _write_atomic(data, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+def save_snapshot(rpi_ids, path=SNAPSHOT_PATH):
+    """
+    Atomically write the MAC: RPI-ID map to the snapshot file.
+
+    Args:
+        rpi_ids (dict): MAC: RPI-ID pairs.
+        path (string): Snapshot file path.
+    """
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "rpi_ids": rpi_ids,
+    }
+    try:
+        _write_atomic(snapshot, path)
+    except OSError as e:
+        print(f"Error writing registry snapshot: {e}")
+
+
+class RpiRegistry:
+    """
+    In-memory two-way MAC <-> RPI-ID registry backed by the `config` node.
+
+    The whole node is loaded once and both lookups are answered from dicts.
+    The registry is kept fresh either by a `db.reference("config").listen`
+    stream (see `start_listener`) or by reloading once `ttl_sec` has passed.
+    """
+
+    def __init__(self, ttl_sec=REGISTRY_TTL_SEC, snapshot_path=SNAPSHOT_PATH):
+        self.ttl_sec = ttl_sec
+        self.snapshot_path = snapshot_path
+        self.snapshot_time = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._lock = threading.RLock()
+        self._config = dict()
+        self._mac_to_rpi = dict()
+        self._rpi_to_mac = dict()
+        self._loaded_at = None
+        self._listener = None
+
+    def _index(self, key):
+        val = self._config.get(key)
+        if not isinstance(val, dict) or "mac" not in val:
+            return
+        mac = val["mac"].replace(":", "-")
+        rpi_id = val.get("rpi_id")
+        if rpi_id:
+            self._mac_to_rpi[mac] = rpi_id
+            # Keep the first match, as the ordered query used to
+            self._rpi_to_mac.setdefault(rpi_id, mac)
+
+    def _unindex(self, key):
+        val = self._config.get(key)
+        if not isinstance(val, dict) or "mac" not in val:
+            return
+        mac = val["mac"].replace(":", "-")
+        rpi_id = val.get("rpi_id")
+        if rpi_id and self._mac_to_rpi.get(mac) == rpi_id:
+            del self._mac_to_rpi[mac]
+        if rpi_id and self._rpi_to_mac.get(rpi_id) == mac:
+            del self._rpi_to_mac[rpi_id]
+            # Another entry may carry the same RPI-ID
+            for other in self._config.values():
+                if (isinstance(other, dict) and other is not val
+                        and other.get("rpi_id") == rpi_id
+                        and "mac" in other):
+                    self._rpi_to_mac[rpi_id] = other["mac"].replace(":", "-")
+                    break
+
+    def _rebuild(self, config):
+        self._config = dict(config) if config else dict()
+        self._mac_to_rpi = dict()
+        self._rpi_to_mac = dict()
+        for key in self._config:
+            self._index(key)
+        self._loaded_at = time.monotonic()
+
+    def _put(self, parts, data):
+        if not parts:
+            self._rebuild(data)
+            return
+        key = parts[0]
+        self._unindex(key)
+        if len(parts) == 1:
+            entry = data
+        else:
+            entry = dict(self._config.get(key) or {})
+            node = entry
+            for part in parts[1:-1]:
+                node[part] = dict(node.get(part) or {})
+                node = node[part]
+            if data is None:
+                node.pop(parts[-1], None)
+            else:
+                node[parts[-1]] = data
+        if entry is None:
+            self._config.pop(key, None)
+        else:
+            self._config[key] = entry
+        self._index(key)
+
+    def _save_snapshot(self):
+        if self.snapshot_path:
+            save_snapshot(dict(self._mac_to_rpi), self.snapshot_path)
+
+    def _on_event(self, event):
+        parts = [part for part in event.path.split("/") if part]
+        with self._lock:
+            if event.event_type == "put":
+                self._put(parts, event.data)
+                if not parts:
+                    self._save_snapshot()
+                    self.snapshot_time = None
+            elif event.event_type == "patch":
+                for child, value in (event.data or {}).items():
+                    self._put(
+                        parts + [part for part in child.split("/") if part],
+                        value)
+            self.refreshes += 1
+
+    def load(self, config):
+        """
+        Load a `config` node already at hand, such as an export.
+
+        Args:
+            config (dict): DB key: {"mac": ..., "rpi_id": ...} entries.
+        """
+        with self._lock:
+            self._rebuild(config)
+            self.refreshes += 1
+
+    def refresh(self):
+        """
+        Reload the whole `config` node from Firebase DB and persist the
+        resulting MAC: RPI-ID map to the snapshot file.
+        """
+        init_app()
+        with metrics.FIREBASE_SECONDS.time(op="refresh"):
+            config = db.reference("config").get()
+        with self._lock:
+            self._rebuild(config)
+            self.refreshes += 1
+            self._save_snapshot()
+            self.snapshot_time = None
+
+    def warm_start(self, reconcile=True):
+        """
+        Serve lookups from the on-disk snapshot right away.
+
+        Args:
+            reconcile (bool): Reload from Firebase DB in a background thread.
+
+        Returns:
+            True if a snapshot was loaded.
+        """
+        rpi_ids, timestamp = load_snapshot(self.snapshot_path)
+        if rpi_ids is None:
+            return False
+        with self._lock:
+            if self._loaded_at is not None:
+                # Already holding live data
+                return True
+            self._rebuild({mac: {"mac": mac, "rpi_id": rpi_id}
+                           for mac, rpi_id in rpi_ids.items()})
+            self.snapshot_time = timestamp
+        if reconcile:
+            threading.Thread(target=self.refresh, daemon=True).start()
+        return True
+
+    def _ensure_fresh(self):
+        with self._lock:
+            if self._listener is not None and self._loaded_at is not None:
+                return
+            if (self._loaded_at is not None
+                    and time.monotonic() - self._loaded_at < self.ttl_sec):
+                return
+        self.refresh()
+
+    def start_listener(self):
+        """
+        Keep the registry in sync through a `config` listen stream.
+
+        The first event of the stream carries the whole node, so no separate
+        load is needed.
+        """
+        init_app()
+        with self._lock:
+            if self._listener is None:
+                self._listener = db.reference("config").listen(
+                    self._on_event)
+
+    def stop_listener(self):
+        """
+        Close the listen stream and fall back to TTL refreshes.
+        """
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.close()
+
+    def _lookup(self, index, key):
+        with metrics.FIREBASE_SECONDS.time(op="lookup"):
+            self._ensure_fresh()
+            with self._lock:
+                value = index.get(key)
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        return value
+
+    def get_rpi_ids(self):
+        self._ensure_fresh()
+        with self._lock:
+            return dict(self._mac_to_rpi)
+
+    def get_mac(self, rpi_id):
+        return self._lookup(self._rpi_to_mac, rpi_id)
+
+    def get_rpi_id(self, mac):
+        return self._lookup(self._mac_to_rpi, mac.replace(":", "-"))
+
+    def stats(self):
+        """
+        Return the hit, miss and refresh counters as a dict.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "devices": len(self._mac_to_rpi),
+                "listening": self._listener is not None,
+                "snapshot_time": self.snapshot_time,
+            }
+
+
+registry = RpiRegistry()
 
 
 def get_rpi_ids():
@@ -16,20 +324,12 @@ def get_rpi_ids():
     Returns:
         A dict containing pairs of MAC key and RPI-ID value.
     """
-    query = db.reference("config").get()
-    values = list(query.values())
-    db_keys = list(query.keys())
-    rpi_ids = dict()
-    if (len(values) > 0 and len(db_keys) > 0):
-        rpi_ids = {val["mac"].replace(":", "-"): val["rpi_id"]
-                   for val in values
-                   if "rpi_id" in val and val["rpi_id"]}
-    return rpi_ids
+    return registry.get_rpi_ids()
 
 
 def get_mac_from_rpi_id(rpi_id):
     """
-    Retrieve MAC based on RPI-ID from Firebase DB.
+    Retrieve MAC based on RPI-ID from the registry.
 
     Args:
         rpi_id (string): RPI-ID.
@@ -37,21 +337,12 @@ def get_mac_from_rpi_id(rpi_id):
     Returns:
         MAC as string or None if not found
     """
-    query = db.reference("config").order_by_child("rpi_id").equal_to(
-        rpi_id).get()
-    values = list(query.values())
-    db_keys = list(query.keys())
-    mac = None
-    if (len(values) > 0 and len(db_keys) > 0):
-        val = values[0]
-        if "mac" in val:
-            mac = val["mac"].replace(":", "-")
-    return mac
+    return registry.get_mac(rpi_id)
 
 
 def get_rpi_id_from_mac(mac):
     """
-    Retrieve RPI-ID based on MAC from Firebase DB.
+    Retrieve RPI-ID based on MAC from the registry.
 
     Args:
         mac (string): MAC.
@@ -59,14 +350,78 @@ def get_rpi_id_from_mac(mac):
     Returns:
         RPI-ID as string or None if not found
     """
-    mac = mac.replace("-", ":")
-    query = db.reference("config").order_by_child("mac").equal_to(
-        mac).get()
-    values = list(query.values())
-    db_keys = list(query.keys())
-    rpi_id = None
-    if (len(values) > 0 and len(db_keys) > 0):
-        val = values[0]
-        if "rpi_id" in val and val["rpi_id"]:
-            rpi_id = val["rpi_id"]
-    return rpi_id
+    return registry.get_rpi_id(mac)
+
+
+def _as_records(value):
+    # Nodes with integer keys come back as lists
+    if isinstance(value, list):
+        return {str(key): record for key, record in enumerate(value)
+                if record is not None}
+    return dict(value or dict())
+
+
+def _sync_cursor(records, cursor):
+    for record in records.values():
+        timestamp = (record.get("last_timestamp")
+                     if isinstance(record, dict) else None)
+        # NaN never compares greater
+        if (isinstance(timestamp, (int, float))
+                and (cursor is None or timestamp > cursor)):
+            cursor = timestamp
+    return cursor
+
+
+def sync_devices(path=DEVICE_CACHE_PATH, full=False):
+    """
+    Return the device records, fetching only what changed since last time.
+
+    The records are kept in a local cache file. Later calls only query the
+    records whose `last_timestamp` is at least the newest one cached, and
+    reload the whole node every DEVICE_FULL_SYNC_SEC.
+
+    Args:
+        path (string): Cache file path.
+        full (bool): Reload the whole node regardless of the cache.
+
+    Returns:
+        A dict with the Firebase key: device record pairs.
+    """
+    try:
+        with open(path, 'r') as file:
+            cache = json.load(file)
+        if cache.get("version") != DEVICE_CACHE_VERSION:
+            cache = None
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = None
+
+    init_app()
+    ref = db.reference(DEVICES_NODE)
+    now = time.time()
+    if (full or cache is None or cache["cursor"] is None
+            or now - cache["full_sync"] > DEVICE_FULL_SYNC_SEC):
+        with metrics.FIREBASE_SECONDS.time(op="devices_full"):
+            records = _as_records(ref.get())
+        full_sync = now
+        cursor = None
+    else:
+        with metrics.FIREBASE_SECONDS.time(op="devices_delta"):
+            changed = _as_records(ref.order_by_child("last_timestamp")
+                                  .start_at(cache["cursor"]).get())
+        records = cache["records"]
+        records.update(changed)
+        full_sync = cache["full_sync"]
+        cursor = cache["cursor"]
+        print(f"Fetched {len(changed)} changed device records")
+
+    cache = {
+        "version": DEVICE_CACHE_VERSION,
+        "full_sync": full_sync,
+        "cursor": _sync_cursor(records, cursor),
+        "records": records,
+    }
+    try:
+        _write_atomic(cache, path)
+    except OSError as e:
+        print(f"Error writing device cache: {e}")
+    return records
@@ -0,0 +1,135 @@
+# Columnar status of the fleet
+#
+# One slot per device in flat arrays instead of a dict per device, so a
+# 10k-device fleet stays a few hundred kilobytes. Ages, attention and the
+# report rows are computed for the whole fleet at once.
+from array import array
+from collections import namedtuple
+from datetime import datetime, timezone
+
+# Attention levels, indexed by attention code
+ATTENTION = ("NO", "MAYBE", "YES", "IGNR")
+NO, MAYBE, YES, IGNR = range(len(ATTENTION))
+# Ages in minutes
+IGNORE_AGE_MIN = 20160  # 2 weeks
+STALE_AGE_MIN = 120
+ETH_UP = 1
+WLAN_UP = 2
+
+# Row of the pi-monitor report table, in TABLE_FIELD_NAMES order
+Report = namedtuple("Report", ["rpi_id", "mac", "eth", "wifi", "last_report",
+                               "attention"])
+
+
+def attention_code(age, flags):
+    """
+    Classify a device from its report age in minutes and interface flags.
+    """
+    if age > IGNORE_AGE_MIN:
+        # Ignore if RPI age is more than 2 weeks
+        return IGNR
+    if age > STALE_AGE_MIN:
+        return YES
+    if age < STALE_AGE_MIN and flags != ETH_UP | WLAN_UP:
+        # Wi-Fi or Ethernet is down
+        return MAYBE
+    return NO
+
+
+class FleetState:
+    """
+    Latest status of each device, keyed by the MAC of its topic.
+
+    Not thread-safe, callers sharing a state hold their own lock.
+    """
+
+    def __init__(self):
+        self._slots = dict()
+        # eth0 MAC as published by the Pi
+        self.macs = list()
+        # Report time as a UNIX timestamp
+        self.report_times = array("d")
+        # ETH_UP | WLAN_UP bits
+        self.flags = bytearray()
+
+    def __len__(self):
+        return len(self.macs)
+
+    def __contains__(self, pi_mac):
+        return pi_mac in self._slots
+
+    def keys(self):
+        """
+        Return the topic MACs in slot order.
+        """
+        return list(self._slots)
+
+    def update(self, pi_mac, mac, last_msg_time, is_eth_up, is_wlan_up):
+        flags = (ETH_UP if is_eth_up else 0) | (WLAN_UP if is_wlan_up else 0)
+        slot = self._slots.get(pi_mac)
+        if slot is None:
+            self._slots[pi_mac] = len(self.macs)
+            self.macs.append(mac)
+            self.report_times.append(last_msg_time.timestamp())
+            self.flags.append(flags)
+        else:
+            self.macs[slot] = mac
+            self.report_times[slot] = last_msg_time.timestamp()
+            self.flags[slot] = flags
+
+    def classify(self, current_time=None):
+        """
+        Compute the age and attention level of every slot.
+
+        Returns:
+            An (ages in minutes, attention codes) tuple of arrays.
+        """
+        if current_time is None:
+            current_time = datetime.now(timezone.utc)
+        now = current_time.timestamp()
+        ages = array("l", [round((now - report_time) / 60)
+                           for report_time in self.report_times])
+        codes = bytes(map(attention_code, ages, self.flags))
+        return ages, codes
+
+    def reports(self, rpi_ids, current_time=None, include_ignored=True,
+                format_age=str):
+        """
+        Build the report rows of the devices registered as `RPI-*`.
+
+        Args:
+            rpi_ids (dict): Topic MAC: RPI-ID, the first device of an
+                RPI-ID wins.
+            current_time (datetime): Reference time, defaults to now.
+            include_ignored (bool): Keep IGNR rows.
+            format_age (callable): Formats the age in minutes.
+
+        Returns:
+            A list of Report rows sorted by RPI-ID.
+        """
+        ages, codes = self.classify(current_time)
+        picked = dict()
+        for pi_mac, slot in self._slots.items():
+            rpi_id = rpi_ids.get(pi_mac)
+            if (rpi_id is not None and rpi_id.startswith("RPI-")
+                    and rpi_id not in picked):
+                picked[rpi_id] = slot
+        if not include_ignored:
+            picked = {rpi_id: slot for rpi_id, slot in picked.items()
+                      if codes[slot] != IGNR}
+        # Ages repeat a lot across a fleet, format each one once
+        age_labels = dict()
+        rows = list()
+        for rpi_id in sorted(picked):
+            slot = picked[rpi_id]
+            age = ages[slot]
+            label = age_labels.get(age)
+            if label is None:
+                label = age_labels[age] = format_age(age)
+            flags = self.flags[slot]
+            rows.append(Report(
+                rpi_id, self.macs[slot],
+                "UP" if flags & ETH_UP else "DOWN",
+                "UP" if flags & WLAN_UP else "DOWN",
+                label, ATTENTION[codes[slot]]))
+        return rows
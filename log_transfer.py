@@ -0,0 +1,264 @@
+# Compressed and chunked `logs` replies
+#
+# A Pi that opted in may send `out.log` compressed, with `out.encoding` set to
+# one of ENCODINGS (the compressed bytes are base64 encoded). A long log may
+# also be split across several replies sharing a `transfer_id`, each carrying
+# its `part` index (from 0) and the `total` number of parts. Parts are slices
+# of the encoded log and are decoded incrementally as they arrive in order.
+#
+# Decoded logs are spooled to anonymous temporary files, which are removed as
+# soon as they are closed.
+import base64
+import logging
+import tempfile
+import threading
+import time
+import zlib
+
+import metrics
+
+ENCODINGS = {
+    "zlib+base64": zlib.MAX_WBITS,
+    "gzip+base64": zlib.MAX_WBITS | 16,
+}
+# Largest decoded log accepted, in bytes, which bounds each spool file
+MAX_LOG_BYTES = 16 * 1024 * 1024
+# Directory of the spool files, None for the system temporary directory
+SPOOL_DIR = None
+# Incomplete transfers are dropped after this many seconds without a part
+TRANSFER_TTL_SEC = 120
+MAX_TRANSFERS = 64
+
+
+class TransferError(Exception):
+    """
+    Raised when a log cannot be decoded or exceeds the size cap.
+    """
+
+
+def capability(max_bytes=MAX_LOG_BYTES):
+    """
+    Return what cmd-monitor accepts, to be advertised in `logs` commands.
+    """
+    return {
+        "encodings": list(ENCODINGS),
+        "chunked": True,
+        "max_bytes": max_bytes,
+    }
+
+
+def spool_file():
+    return tempfile.TemporaryFile(prefix="log-", dir=SPOOL_DIR)
+
+
+class LogDecoder:
+    """
+    Incrementally decode an encoded log into a binary file, enforcing the
+    size cap.
+    """
+
+    def __init__(self, encoding, sink, max_bytes=MAX_LOG_BYTES):
+        if encoding not in ENCODINGS and encoding not in (None, "plain"):
+            raise TransferError(f"Unknown log encoding {encoding}")
+        self.sink = sink
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._plain = encoding in (None, "plain")
+        self._pending = ""
+        self._decompressor = (None if self._plain
+                              else zlib.decompressobj(ENCODINGS[encoding]))
+
+    def _append(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise TransferError(f"Log larger than {self.max_bytes} bytes")
+        self.sink.write(data)
+
+    def feed(self, text):
+        if self._plain:
+            self._append(text.encode())
+            return
+        # base64 decodes by groups of 4 characters, keep the remainder
+        text = self._pending + text
+        cut = len(text) - len(text) % 4
+        self._pending = text[cut:]
+        try:
+            data = base64.b64decode(text[:cut], validate=True)
+            # Bound the output so a small bomb cannot inflate past the cap
+            self._append(self._decompressor.decompress(
+                data, self.max_bytes - self.size + 1))
+            while self._decompressor.unconsumed_tail:
+                self._append(self._decompressor.decompress(
+                    self._decompressor.unconsumed_tail,
+                    self.max_bytes - self.size + 1))
+        except (ValueError, zlib.error) as e:
+            raise TransferError(f"Cannot decode log: {e}")
+
+    def finish(self):
+        """
+        Flush the decoder and rewind the sink.
+
+        Returns:
+            The decoded size in bytes.
+        """
+        if not self._plain:
+            if self._pending:
+                raise TransferError("Truncated base64 log")
+            try:
+                self._append(self._decompressor.flush())
+            except zlib.error as e:
+                raise TransferError(f"Cannot decode log: {e}")
+            if not self._decompressor.eof:
+                raise TransferError("Truncated compressed log")
+        self.sink.flush()
+        self.sink.seek(0)
+        return self.size
+
+
+def spool_log(out, max_bytes=MAX_LOG_BYTES):
+    """
+    Decode the log of a single `logs` reply `out` dict into a spool file.
+
+    Returns:
+        A (spool file, size) tuple, the caller closes the file.
+    """
+    spool = spool_file()
+    try:
+        decoder = LogDecoder(out.get("encoding"), spool, max_bytes)
+        decoder.feed(out["log"])
+        return spool, decoder.finish()
+    except BaseException:
+        spool.close()
+        raise
+
+
+class Transfer:
+    __slots__ = ("total", "decoder", "next_part", "parts", "buffered",
+                 "last_seen")
+
+    def __init__(self, total, encoding, max_bytes):
+        self.total = total
+        sink = spool_file()
+        try:
+            self.decoder = LogDecoder(encoding, sink, max_bytes)
+        except BaseException:
+            sink.close()
+            raise
+        self.next_part = 0
+        # Parts received ahead of `next_part` and their total length
+        self.parts = dict()
+        self.buffered = 0
+        self.last_seen = time.monotonic()
+
+
+class TransferAssembler:
+    """
+    Reassemble chunked `logs` replies.
+
+    Parts are decoded as soon as they are contiguous, parts arriving early
+    are buffered. Transfers idle for `ttl_sec` are evicted, as is the oldest
+    one when more than `max_transfers` are in progress. Completed and failed
+    transfers are remembered for `ttl_sec`, to drop their late parts.
+    """
+
+    def __init__(self, ttl_sec=TRANSFER_TTL_SEC, max_transfers=MAX_TRANSFERS,
+                 max_bytes=MAX_LOG_BYTES):
+        self.ttl_sec = ttl_sec
+        self.max_transfers = max_transfers
+        self.max_bytes = max_bytes
+        self._transfers = dict()
+        # Key of the ended transfers: monotonic time ended, in that order
+        self._ended = dict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        for key, transfer in list(self._transfers.items()):
+            if now - transfer.last_seen > self.ttl_sec:
+                logging.warning("Dropping stale log transfer %s", key)
+                metrics.TRANSFERS_EVICTED.inc(reason="stale")
+                self._transfers.pop(key).decoder.sink.close()
+        while len(self._transfers) >= self.max_transfers:
+            key = min(self._transfers,
+                      key=lambda k: self._transfers[k].last_seen)
+            logging.warning("Dropping log transfer %s, too many in progress",
+                            key)
+            metrics.TRANSFERS_EVICTED.inc(reason="overflow")
+            self._transfers.pop(key).decoder.sink.close()
+
+    def _end(self, key, now):
+        # Called with the lock held
+        self._transfers.pop(key, None)
+        while self._ended:
+            oldest = next(iter(self._ended))
+            if now - self._ended[oldest] <= self.ttl_sec:
+                break
+            del self._ended[oldest]
+        self._ended.pop(key, None)
+        self._ended[key] = now
+
+    def add(self, mac, msg_payload):
+        """
+        Add one part of a chunked reply.
+
+        Returns:
+            A (spool file, size) tuple once the last part arrived, None
+            before. The caller closes the file.
+
+        Raises:
+            TransferError: The transfer is invalid or too large, it is
+                dropped along with its later parts.
+        """
+        key = (mac, msg_payload["transfer_id"])
+        part = int(msg_payload["part"])
+        total = int(msg_payload["total"])
+        out = msg_payload["out"]
+        now = time.monotonic()
+        with self._lock:
+            ended = self._ended.get(key)
+            if ended is not None and now - ended <= self.ttl_sec:
+                # Late or duplicate part of an ended transfer
+                return None
+            transfer = self._transfers.get(key)
+            if transfer is None:
+                self._evict(now)
+                try:
+                    transfer = Transfer(total, out.get("encoding"),
+                                        self.max_bytes)
+                except TransferError:
+                    self._end(key, now)
+                    raise
+                self._transfers[key] = transfer
+            transfer.last_seen = now
+
+        # Parts of one device are handled in order by a single worker, so
+        # decoding happens outside the lock
+        try:
+            if not 0 <= part < transfer.total:
+                raise TransferError(f"Invalid part {part}/{total}")
+            if part < transfer.next_part or part in transfer.parts:
+                # Duplicate delivery of a QoS 1 message
+                return None
+            transfer.parts[part] = out["log"]
+            transfer.buffered += len(out["log"])
+            if transfer.buffered > transfer.decoder.max_bytes:
+                raise TransferError("Too many parts buffered")
+            while transfer.next_part in transfer.parts:
+                text = transfer.parts.pop(transfer.next_part)
+                transfer.buffered -= len(text)
+                transfer.decoder.feed(text)
+                transfer.next_part += 1
+            if transfer.next_part < transfer.total:
+                return None
+            size = transfer.decoder.finish()
+        except BaseException:
+            with self._lock:
+                self._end(key, time.monotonic())
+            transfer.decoder.sink.close()
+            raise
+        with self._lock:
+            self._end(key, time.monotonic())
+        return transfer.decoder.sink, size
+
+    def depth(self):
+        with self._lock:
+            return len(self._transfers)
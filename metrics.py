@@ -0,0 +1,191 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics = list()
+_lock = threading.Lock()
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs)
+    return "{" + escaped + "}"
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by labels.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name + _format_labels(self.labelnames, key), value
+
+
+class Histogram:
+    """
+    Distribution of observed values, optionally split by labels.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Label values: [bucket counts..., +Inf count, sum]
+        self._values = dict()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, counts in sorted(self._values.items()):
+            cumulative = 0
+            bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield (self.name + "_bucket" + _format_labels(
+                    self.labelnames, key, ("le", bound)), cumulative)
+            labels = _format_labels(self.labelnames, key)
+            yield self.name + "_count" + labels, cumulative
+            yield self.name + "_sum" + labels, counts[-1]
+
+
+def counter(name, doc, labelnames=()):
+    metric = Counter(name, doc, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, doc, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def render():
+    """
+    Render every metric in the Prometheus text exposition format.
+    """
+    lines = list()
+    with _lock:
+        for metric in _metrics:
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample, value in metric.samples():
+                lines.append(f"{sample} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    """
+    Write the metrics to a file, for one-shot runs.
+    """
+    with open(path, 'w') as file:
+        file.write(render())
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, addr="127.0.0.1"):
+    """
+    Serve the metrics on http://addr:port/ from a background thread.
+    """
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics",
+                     daemon=True).start()
+    return server
+
+
+# Metrics of the monitors hot paths
+MQTT_RECEIVED = counter(
+    "schmidt_mqtt_messages_received_total",
+    "MQTT messages received.", ["tool", "topic"])
+MQTT_DISCARDED = counter(
+    "schmidt_mqtt_messages_discarded_total",
+    "MQTT messages discarded.", ["tool", "reason"])
+MESSAGE_SECONDS = histogram(
+    "schmidt_message_handling_seconds",
+    "Time spent handling one MQTT message.", ["tool", "type"])
+FIREBASE_SECONDS = histogram(
+    "schmidt_firebase_seconds",
+    "Firebase registry lookup and refresh latency.", ["op"])
+SLACK_SECONDS = histogram(
+    "schmidt_slack_post_seconds",
+    "Slack post latency.", ["result"])
+SLACK_FAILURES = counter(
+    "schmidt_slack_post_failures_total",
+    "Slack posts that failed or were rate limited.", ["reason"])
+TRANSFERS_EVICTED = counter(
+    "schmidt_log_transfers_evicted_total",
+    "Incomplete chunked log transfers dropped.", ["reason"])
+ALERTS = counter(
+    "schmidt_alerts_total",
+    "Attention alerts raised and cleared by the pi-monitor daemon.",
+    ["kind", "action"])
+CLUSTER_EVENTS = counter(
+    "schmidt_cluster_events_total",
+    "Replies forwarded and commands claimed between cmd-monitor nodes.",
+    ["event"])
+COLLECTOR_SECONDS = histogram(
+    "schmidt_collector_run_seconds",
+    "Duration of a pi-monitor collection run.", ["reason"],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
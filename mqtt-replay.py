@@ -0,0 +1,205 @@
+# Record Schmidt MQTT traffic and replay it into the monitors handlers
+#
+#   python mqtt-replay.py record traffic.smq
+#   python mqtt-replay.py replay traffic.smq --target cmd-monitor --speed 10
+#
+# The capture is an append-only file: a magic header, then one record per
+# message made of a fixed header (arrival time, QoS, retain flag, topic and
+# payload lengths) followed by the topic and the raw payload.
+import argparse
+import importlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import benchmark
+import firebase
+pi_monitor = importlib.import_module("pi-monitor")
+
+MAGIC = b"SMQ1"
+RECORD_HEADER = struct.Struct("<dBBHI")
+DEFAULT_TOPIC = "Schmidt/#"
+
+
+def write_record(file, arrival, topic, payload, qos, retain):
+    topic = topic.encode()
+    file.write(RECORD_HEADER.pack(arrival, qos, int(retain), len(topic),
+                                  len(payload)))
+    file.write(topic)
+    file.write(payload)
+
+
+def read_records(path):
+    """
+    Yield (arrival, topic, payload, qos, retain) tuples from a capture.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an MQTT capture")
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # End of file, or a record cut short by a crash
+                return
+            arrival, qos, retain, topic_len, payload_len = \
+                RECORD_HEADER.unpack(header)
+            topic = file.read(topic_len)
+            payload = file.read(payload_len)
+            if len(payload) < payload_len:
+                return
+            yield arrival, topic.decode(), payload, qos, bool(retain)
+
+
+def record(path, topic=DEFAULT_TOPIC, duration_sec=None):
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+    count = 0
+    with open(path, 'ab') as file:
+        if new_file:
+            file.write(MAGIC)
+
+        def on_connect(client, userdata, flags, rc):
+            if rc == 0:
+                print(f"Connected, recording {topic} to {path}")
+            client.subscribe(topic, qos=1)
+
+        def on_message(client, userdata, msg):
+            nonlocal count
+            write_record(file, time.time(), msg.topic, msg.payload, msg.qos,
+                         msg.retain)
+            file.flush()
+            count += 1
+
+        client = pi_monitor.create_client(on_connect, on_message)
+        client.loop_start()
+        try:
+            if duration_sec:
+                time.sleep(duration_sec)
+            else:
+                while True:
+                    time.sleep(1)
+        except KeyboardInterrupt:
+            print("\nKeyboard Interrupt !")
+        finally:
+            client.disconnect()
+            client.loop_stop()
+    print(f"Recorded {count} messages")
+
+
+def shift_timestamp(payload, offset):
+    """
+    Move the `timestamp` of a JSON payload by `offset`, so that its age at
+    replay is its age at capture.
+    """
+    try:
+        msg_payload = json.loads(payload)
+        timestamp = datetime.fromisoformat(msg_payload["timestamp"])
+    except (ValueError, TypeError, KeyError):
+        return payload
+    msg_payload["timestamp"] = (timestamp + offset).isoformat()
+    return json.dumps(msg_payload).encode()
+
+
+def replay(path, target, speed, registry_path):
+    """
+    Replay a capture into the handlers of `target`.
+
+    Args:
+        speed (float): Replay speed factor, 0 replays as fast as possible.
+        registry_path (string): Registry snapshot used for RPI-IDs.
+    """
+    rpi_ids, _ = firebase.load_snapshot(os.path.abspath(registry_path))
+    if rpi_ids is None:
+        sys.exit(f"No registry snapshot at {registry_path}")
+    records = list(read_records(path))
+    if not records:
+        sys.exit(f"No message in {path}")
+
+    slack = benchmark.FakeSlack()
+    _, cmd_monitor = benchmark.load_modules(
+        tempfile.mkdtemp(prefix="replay-"),
+        {mac: {"mac": mac, "rpi_id": rpi_id}
+         for mac, rpi_id in rpi_ids.items()},
+        slack)
+    if target == "cmd-monitor":
+        broker = benchmark.FakeBroker()
+        client = benchmark.FakeClient(broker, cmd_monitor.on_message)
+        cmd_monitor.client = client
+        handle = cmd_monitor.on_message
+    else:
+        collector = pi_monitor.FleetCollector(firebase.get_rpi_ids())
+        client = None
+        handle = collector.on_message
+
+    if target == "pi-monitor":
+        records = [record for record in records
+                   if record[1].endswith("/report/status")]
+        if not records:
+            sys.exit(f"No status message in {path}")
+
+    # Timestamps are moved to the planned replay times up front, so that
+    # decoding them is not measured. A message planned at the start of the
+    # replay reaches the handlers older by the preparation time only.
+    first_arrival = records[0][0]
+    start_wall = time.time()
+    messages = list()
+    for arrival, topic, payload, qos, retain in records:
+        elapsed = arrival - first_arrival
+        planned = start_wall + (elapsed / speed if speed else 0)
+        messages.append((elapsed, benchmark.FakeMessage(
+            topic, shift_timestamp(payload,
+                                   timedelta(seconds=planned - arrival)),
+            qos, retain)))
+
+    start = time.perf_counter()
+    for elapsed, msg in messages:
+        if speed:
+            delay = elapsed / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        handle(client, None, msg)
+
+    if target == "cmd-monitor":
+        cmd_monitor.reply_dispatcher.join()
+        cmd_monitor.reply_sender.flush()
+    duration = time.perf_counter() - start
+    print(f"Replayed {len(messages)} messages in {duration:.3f}s "
+          f"({len(messages) / duration:.1f} msgs/s), captured over "
+          f"{records[-1][0] - first_arrival:.1f}s")
+    if target == "cmd-monitor":
+        print(f"Slack posts: {slack.posts}, uploads: {slack.uploads}")
+    else:
+        print(f"Collected {len(collector.state)} reports")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Record and replay Schmidt MQTT traffic")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record",
+                                          help="Record live traffic")
+    record_parser.add_argument("capture", help="Capture file, appended to")
+    record_parser.add_argument("--topic", default=DEFAULT_TOPIC,
+                               help=f"Topic filter, default={DEFAULT_TOPIC}")
+    record_parser.add_argument("--duration", type=float,
+                               help="Stop after this many seconds")
+    replay_parser = subparsers.add_parser(
+        "replay", help="Replay a capture into the monitors handlers")
+    replay_parser.add_argument("capture", help="Capture file")
+    replay_parser.add_argument("--target", default="cmd-monitor",
+                               choices=["cmd-monitor", "pi-monitor"],
+                               help="Handlers to replay into")
+    replay_parser.add_argument("--speed", type=float, default=1.0,
+                               help="Speed factor, 0 for max speed, "
+                                    "default=1")
+    replay_parser.add_argument("--registry", default=firebase.SNAPSHOT_PATH,
+                               help=("Registry snapshot giving RPI-IDs, "
+                                     f"default={firebase.SNAPSHOT_PATH}"))
+    args = parser.parse_args()
+    if args.command == "record":
+        record(args.capture, args.topic, args.duration)
+    else:
+        replay(args.capture, args.target, args.speed, args.registry)
@@ -0,0 +1,186 @@
+# Decoding of the MQTT payloads published by the Pis
+#
+# Payloads are parsed from bytes with orjson when it is installed, and the
+# standard json module otherwise. Each topic type has a schema compiled once
+# at import. Messages from unknown MACs or with a stale timestamp are
+# rejected from the topic and a peek at the raw bytes, before any parsing.
+import json
+import time
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+TIMESTAMP_KEY = b'"timestamp"'
+
+
+class PayloadError(ValueError):
+    """
+    Raised when a message is rejected, `reason` is the discard reason.
+    """
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+if orjson is not None:
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            raise PayloadError("parse", f"Cannot parse payload: {e}")
+else:
+    def loads(data):
+        try:
+            return json.loads(data)
+        except (ValueError, UnicodeDecodeError) as e:
+            raise PayloadError("parse", f"Cannot parse payload: {e}")
+
+
+class Schema:
+    """
+    Required keys of a payload and their types.
+
+    Args:
+        name (string): Name used in error messages.
+        fields (dict): Key: type, tuple of types, nested Schema, or object
+            when any value is accepted.
+    """
+
+    __slots__ = ("name", "required", "checks")
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.required = frozenset(fields)
+        # Only the keys with a constraint are visited after the key check
+        self.checks = tuple((key, kind) for key, kind in fields.items()
+                            if kind is not object)
+
+    def check(self, payload):
+        if type(payload) is not dict:
+            raise PayloadError("schema", f"{self.name} payload is not an "
+                                         "object")
+        if not self.required <= payload.keys():
+            missing = sorted(self.required - payload.keys())
+            raise PayloadError("missing_param",
+                               f"{', '.join(missing)} not in {self.name} "
+                               "payload")
+        for key, kind in self.checks:
+            if type(kind) is Schema:
+                kind.check(payload[key])
+            elif not isinstance(payload[key], kind):
+                raise PayloadError("schema",
+                                   f"{self.name} {key} is not {kind}")
+        return payload
+
+
+STATUS = Schema("status", {
+    "mac": str,
+    "timestamp": str,
+    "out": Schema("status out", {"ifaces": list}),
+})
+REPLY = Schema("reply", {
+    "mac": str,
+    "timestamp": str,
+    "type": str,
+    "result": str,
+    "out": object,
+    "err": object,
+})
+# Schema per topic type, the last level of the topic
+SCHEMAS = {
+    "status": STATUS,
+    "config": REPLY,
+}
+
+
+def topic_mac(topic):
+    return topic.split("/", 2)[1]
+
+
+def peek_timestamp(data):
+    """
+    Find the `timestamp` of a raw payload without parsing it.
+
+    Returns:
+        The timestamp as a datetime, or None when it cannot be located
+        unambiguously.
+    """
+    start = data.find(TIMESTAMP_KEY)
+    if start < 0 or data.find(TIMESTAMP_KEY, start + 1) >= 0:
+        return None
+    start = data.find(b'"', start + len(TIMESTAMP_KEY))
+    end = data.find(b'"', start + 1)
+    if start < 0 or end < 0:
+        return None
+    try:
+        return datetime.fromisoformat(data[start + 1:end].decode())
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def age_sec(timestamp, now=None):
+    """
+    Return the absolute age of a timestamp in seconds, naive timestamps are
+    taken as local time.
+    """
+    if now is None:
+        now = time.time()
+    return abs(now - timestamp.timestamp())
+
+
+def decode(msg, schema=None, known_macs=None, max_age_sec=None):
+    """
+    Decode and validate an MQTT message.
+
+    Args:
+        msg (MQTTMessage): Message on a `Schmidt/<mac>/report/...` topic.
+        schema (Schema): Schema to check, defaults to the topic type one.
+        known_macs (set): Reject other topic MACs when given.
+        max_age_sec (int): Reject older timestamps when given.
+
+    Returns:
+        The payload dict.
+
+    Raises:
+        PayloadError: The message is rejected.
+    """
+    topic = msg.topic
+    if known_macs is not None and topic_mac(topic) not in known_macs:
+        raise PayloadError("unknown_mac", f"Unknown MAC in {topic}")
+    timestamp = None
+    if max_age_sec is not None:
+        timestamp = peek_timestamp(msg.payload)
+        if timestamp is not None and age_sec(timestamp) > max_age_sec:
+            raise PayloadError("stale", f"Old payload with timestamp "
+                                        f"{timestamp.isoformat()}")
+
+    payload = loads(msg.payload)
+    if schema is None:
+        schema = SCHEMAS[topic.rsplit("/", 1)[1]]
+    schema.check(payload)
+
+    if max_age_sec is not None and timestamp is None:
+        # The peek was ambiguous, check the parsed timestamp
+        try:
+            timestamp = datetime.fromisoformat(payload["timestamp"])
+        except (KeyError, TypeError, ValueError):
+            raise PayloadError("parse", "Invalid timestamp")
+        if age_sec(timestamp) > max_age_sec:
+            raise PayloadError("stale", f"Old payload with timestamp "
+                                        f"{payload['timestamp']}")
+    return payload
+
+
+def iface_index(ifaces):
+    """
+    Index a status `ifaces` list by interface name in one pass, the first
+    entry of a name wins.
+    """
+    index = dict()
+    for iface in ifaces:
+        index.setdefault(iface.get("name"), iface)
+    return index
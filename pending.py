@@ -0,0 +1,167 @@
+import heapq
+import itertools
+import threading
+import time
+import uuid
+
+from prettytable import PrettyTable
+
+# Seconds to wait for a reply, per command (first topic level)
+DEFAULT_TIMEOUT_SEC = 60
+COMMAND_TIMEOUT_SEC = {
+    "gitreset": 180,
+    "update": 900,
+    "reboot": 300,
+}
+LATENCY_FIELD_NAMES = ["RPI-ID", "REPLIES", "TIMEOUTS", "LAST", "AVG", "MAX"]
+
+
+def new_correlation_id(prefix=""):
+    return f"{prefix}{uuid.uuid4().hex[:12]}"
+
+
+def command_timeout(cmd_type):
+    return COMMAND_TIMEOUT_SEC.get(cmd_type.split("/")[0], DEFAULT_TIMEOUT_SEC)
+
+
+class PendingRequest:
+    __slots__ = ("corr_id", "mac", "rpi_id", "cmd_type", "sent_at",
+                 "deadline", "notify")
+
+    def __init__(self, corr_id, mac, rpi_id, cmd_type, timeout_sec, notify):
+        self.corr_id = corr_id
+        self.mac = mac
+        self.rpi_id = rpi_id
+        self.cmd_type = cmd_type
+        self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + timeout_sec
+        self.notify = notify
+
+
+class LatencyStats:
+    __slots__ = ("replies", "timeouts", "last", "total", "max")
+
+    def __init__(self):
+        self.replies = 0
+        self.timeouts = 0
+        self.last = None
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.replies += 1
+        self.last = latency
+        self.total += latency
+        self.max = max(self.max, latency)
+
+
+class PendingRequests:
+    """
+    Track published commands until their reply arrives.
+
+    Requests are keyed by a correlation ID carried in the command. A reply
+    echoing the ID resolves its request exactly, otherwise the oldest
+    pending request with the same MAC and command type is resolved. Per
+    device round-trip latency is recorded, and `on_timeout(request)` is
+    called for requests published with `notify` that got no reply in time.
+    Correlation IDs start with `id_prefix`.
+    """
+
+    def __init__(self, on_timeout, id_prefix=""):
+        self.on_timeout = on_timeout
+        self.id_prefix = id_prefix
+        self.latency = dict()
+        self._requests = dict()
+        self._heap = list()
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        threading.Thread(target=self._expire_loop, name="pending",
+                         daemon=True).start()
+
+    def add(self, mac, rpi_id, cmd_type, timeout_sec=None, notify=True):
+        """
+        Register a command about to be published.
+
+        Returns:
+            string: The correlation ID to carry in the command.
+        """
+        if timeout_sec is None:
+            timeout_sec = command_timeout(cmd_type)
+        request = PendingRequest(new_correlation_id(self.id_prefix),
+                                 mac.replace(":", "-"), rpi_id, cmd_type,
+                                 timeout_sec, notify)
+        with self._cond:
+            self._requests[request.corr_id] = request
+            heapq.heappush(self._heap, (request.deadline,
+                                        next(self._counter), request.corr_id))
+            self._cond.notify()
+        return request.corr_id
+
+    def resolve(self, mac, cmd_type, corr_id=None):
+        """
+        Match a reply against the pending requests.
+
+        Returns:
+            A (request, latency in seconds) tuple, or None for a reply nobody
+            is waiting for.
+        """
+        mac = mac.replace(":", "-")
+        with self._cond:
+            request = self._requests.get(corr_id) if corr_id else None
+            if request is None:
+                candidates = [req for req in self._requests.values()
+                              if req.mac == mac and req.cmd_type == cmd_type]
+                if not candidates:
+                    return None
+                request = min(candidates, key=lambda req: req.sent_at)
+            del self._requests[request.corr_id]
+            latency = time.monotonic() - request.sent_at
+            self._stats(request.rpi_id).add(latency)
+        return request, latency
+
+    def _stats(self, rpi_id):
+        stats = self.latency.get(rpi_id)
+        if stats is None:
+            stats = self.latency[rpi_id] = LatencyStats()
+        return stats
+
+    def _expire_loop(self):
+        while True:
+            expired = list()
+            with self._cond:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, corr_id = heapq.heappop(self._heap)
+                    request = self._requests.pop(corr_id, None)
+                    if request is not None:
+                        self._stats(request.rpi_id).timeouts += 1
+                        expired.append(request)
+                if not expired:
+                    wait_sec = (self._heap[0][0] - now if self._heap
+                                else None)
+                    self._cond.wait(wait_sec)
+                    continue
+            for request in expired:
+                if request.notify:
+                    self.on_timeout(request)
+
+    def depth(self):
+        with self._cond:
+            return len(self._requests)
+
+    def create_latency_table(self):
+        """
+        Return a table of the per-device round-trip latency, in seconds.
+        """
+        table = PrettyTable()
+        table.field_names = LATENCY_FIELD_NAMES
+        with self._cond:
+            rows = sorted(self.latency.items())
+            for rpi_id, stats in rows:
+                table.add_row([
+                    rpi_id, stats.replies, stats.timeouts,
+                    f"{stats.last:.1f}" if stats.last is not None else "-",
+                    (f"{stats.total / stats.replies:.1f}"
+                     if stats.replies else "-"),
+                    f"{stats.max:.1f}" if stats.replies else "-"])
+        return table
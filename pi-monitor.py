@@ -1,20 +1,44 @@
 from zoneinfo import ZoneInfo
 import paho.mqtt.client as mqtt
+import asyncio
 import time
-import requests
 import json
-from datetime import datetime, timezone
+from datetime import datetime
 from prettytable import PrettyTable
 import argparse
+import threading
 import firebase
+from slack_table import paginate_table
+import slack_sender
+import metrics
+import payloads
+import durations
+import changes
+import alerts
+from fleet_state import FleetState
+from staleness import StalenessIndex, STALE_SEC
+from status_store import StatusStore, STORE_PATH
 
 # Topic expression using a single wildcard
 topic = "Schmidt/+/report/status"
 
-reports = list()
-seen = set()
-rpi_ids = dict()
+# Collectors currently running on a shared client, see dispatch()
+active_collectors = set()
+active_lock = threading.Lock()
+# Default seconds without new messages after which collection stops
+QUIET_SEC = 1.0
 TABLE_FIELD_NAMES = ["RPI-ID", "MAC", "ETH", "WIFI", "LAST REPORT", "ATTN"]
+# Per-device states of the last change-only report
+CHANGES_PATH = ".pi-monitor-states.json"
+ATTENTION_MENTIONS = "<@U048TQS3XUK> <@U05QKN65PEY>"
+# Daemon mode: seconds between fleet evaluations and between digests
+EVAL_SEC = 60
+DIGEST_SEC = 6 * 3600
+# An interface must stay down this long to alert, and up this long to clear
+IFACE_DEBOUNCE_SEC = 300
+IFACE_CLEAR_SEC = 600
+# An alert of a device is raised at most once per this many seconds
+ALERT_COOLDOWN_SEC = 3600
 
 
 def format_minutes_to_human_readable(total_minutes: int) -> str:
@@ -32,39 +56,14 @@ def format_minutes_to_human_readable(total_minutes: int) -> str:
     """
     if total_minutes <= 0:
         return "0 mins"
-
-    # Define conversion constants
-    MINUTES_IN_HOUR = 60
-    MINUTES_IN_DAY = MINUTES_IN_HOUR * 24
-    MINUTES_IN_WEEK = MINUTES_IN_DAY * 7
-    # Approximating a month as 30 days for simplicity
-    MINUTES_IN_MONTH = MINUTES_IN_DAY * 30
-
-    # Prioritize larger units
-    if total_minutes >= MINUTES_IN_MONTH:
-        # Calculate months and remaining minutes
-        months = total_minutes // MINUTES_IN_MONTH
-        # For simplicity, we'll just show months here.
-        return f"{months} Mth{'s' if months != 1 else ''}"
-    elif total_minutes >= MINUTES_IN_WEEK:
-        days = total_minutes // MINUTES_IN_WEEK
-        return f"{days} wk{'s' if days != 1 else ''}"
-    elif total_minutes >= MINUTES_IN_DAY:
-        days = total_minutes // MINUTES_IN_DAY
-        return f"{days} day{'s' if days != 1 else ''}"
-    elif total_minutes >= MINUTES_IN_HOUR:
-        hours = total_minutes // MINUTES_IN_HOUR
-        return f"{hours} hr{'s' if hours != 1 else ''}"
-    else:
-        # If less than an hour, show in minutes
-        return f"{total_minutes} min{'s' if total_minutes != 1 else ''}"
+    return durations.format_minutes(total_minutes, durations.REPORT_UNITS)
 
 
-# Create a report table from list of dict
+# Create a report table from a list of rows
 def create_report_table(input_list):
     table = PrettyTable()
     table.field_names = TABLE_FIELD_NAMES
-    table.add_rows([row.values() for row in input_list])
+    table.add_rows(input_list)
     return table
 
 
@@ -74,12 +73,6 @@ def load_mqtt_config():
     return conf
 
 
-def load_slack_config():
-    with open('.slack-config.json', 'r') as file:
-        cf = json.load(file)
-    return cf
-
-
 # Send a string
 def send_slack_msg_str(input_str):
     payload = {
@@ -93,93 +86,153 @@ def send_slack_msg_str(input_str):
             }
         ]
     }
-    slack_conf = load_slack_config()
-    requests.post(slack_conf['url'], json=payload)
+    slack_sender.send_webhook_blocks(payload["blocks"])
 
 
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        print("------------Connected successfully, please wait for the "
-              "results -------------")
-    client.subscribe(topic, qos=1)
+def parse_status(retained_msg):
+    """
+    Extract the report time and interface state from a status payload.
 
+    Args:
+        retained_msg (dict): Decoded `report/status` payload.
+
+    Returns:
+        A (last_msg_time, is_eth_up, is_wlan_up) tuple.
+    """
+    last_msg_time = datetime.fromisoformat(
+        retained_msg["timestamp"]).astimezone(ZoneInfo('UTC'))
+
+    # Get the Ethernet and Wi-Fi status
+    interfaces = payloads.iface_index(retained_msg['out']['ifaces'])
+    default_iface = {
+        'up': None,
+        'ip_address': None,
+        'mac_address': None
+    }
+    eth0_data = interfaces.get("eth0", default_iface)
+    wlan0_data = interfaces.get("wlan0", default_iface)
+    wlan1_data = interfaces.get("wlan1", default_iface)
+    is_eth_up = bool(eth0_data['up'] and eth0_data['ip_address'])
+    is_wlan_up = bool(
+        (wlan0_data['up'] and wlan0_data['ip_address'])
+        or (wlan1_data['up'] and wlan1_data['ip_address']))
+    return last_msg_time, is_eth_up, is_wlan_up
+
+
+def build_reports(state, rpi_ids, current_time=None, include_ignored=True):
+    """
+    Build the report table rows of a fleet state, sorted by RPI-ID.
+
+    Args:
+        state (FleetState): Latest status per topic MAC.
+        rpi_ids (dict): Topic MAC: RPI-ID.
+        current_time (datetime): Reference time, defaults to now.
+        include_ignored (bool): Keep IGNR rows.
+
+    Returns:
+        A list of fleet_state.Report rows.
+    """
+    return state.reports(rpi_ids, current_time, include_ignored,
+                         format_minutes_to_human_readable)
+
+
+def publish_reports(reports, experimental=False, include_ignored=False):
+    """
+    Print the report and attention tables and send them to Slack.
+
+    Args:
+        reports (list): Rows sorted by RPI-ID, as built by `build_reports`.
+        experimental (bool): Only print, do not send to Slack.
+        include_ignored (bool): Keep IGNR rows in the report table.
+    """
+    # Filter out ignored rows
+    if not include_ignored:
+        reports = [row for row in reports if row.attention != "IGNR"]
+
+    # Print/send table to slack
+    report_table = create_report_table(reports)
+    print(report_table)
+    if not experimental:
+        print("SENDING REPORT TABLE TO SLACK CHANNEL ...")
+        # Split data due to Slack 3000-characters limit
+        for page in paginate_table(report_table):
+            send_slack_msg_str(f"```{page}```")
+
+    # Generate the attention table (list of devices needing  attention)
+    attn_table = create_report_table(
+        [row for row in reports if row.attention == "YES"])
+    if (len(attn_table.rows) > 0):
+        print(f"Attention table:\n{attn_table}")
+        if not experimental:
+            print("SENDING ATTN TABLE TO SLACK CHANNEL ...")
+            send_slack_msg_str(
+                f"{ATTENTION_MENTIONS}: The following RPIs need attention.")
+            # Split data due to Slack 3000-characters limit
+            for page in paginate_table(attn_table):
+                send_slack_msg_str(f"```{page}```")
+
+    else:
+        print("ALL GOOD! No node needs attention right now.")
+        if not experimental:
+            send_slack_msg_str(
+                "ALL GOOD! No node needs attention right now.")
 
-# The Callback function to execute whenever messages are received
-def on_message(client, userdata, msg):
-    global reports, seen, rpi_ids
-    try:
-        pi_mac = msg.topic.split("/")[1]
-        rpi_id = rpi_ids[pi_mac] if pi_mac in rpi_ids else None
-        if (rpi_id is not None and rpi_id.startswith("RPI-")):
-            report = dict()
-            # get the published msg, extract the timestamp and calculate age
-            retained_msg = json.loads(msg.payload.decode())
-            current_time = datetime.now(timezone.utc)
-            last_msg_time = datetime.fromisoformat(
-                retained_msg["timestamp"]).astimezone(ZoneInfo('UTC'))
-            age = round((current_time - last_msg_time).total_seconds() / 60)
-
-            # Get the Ethernet and Wi-Fi status
-            out_data = retained_msg['out']
-            interfaces = out_data['ifaces']
-
-            default_iface = {
-                'up': None,
-                'ip_address': None,
-                'mac_address': None
-            }
-            eth0_data = next(
-                (iface for iface in interfaces if iface["name"] == "eth0"),
-                default_iface)
-            wlan0_data = next(
-                (iface for iface in interfaces if iface["name"] == "wlan0"),
-                default_iface)
-            wlan1_data = next(
-                (iface for iface in interfaces if iface["name"] == "wlan1"),
-                default_iface)
-            is_eth_up = (eth0_data['up'] and eth0_data['ip_address'])
-            is_wlan_up = (
-                (wlan0_data['up'] and wlan0_data['ip_address'])
-                or (wlan1_data['up'] and wlan1_data['ip_address']))
-
-            report["RPI-ID"] = rpi_id
-            report["MAC"] = retained_msg["mac"]  # eth0 MAC
-            report["ETH_Status"] = "UP" if is_eth_up else "DOWN"
-            report["WiFi_Status"] = "UP" if is_wlan_up else "DOWN"
-
-            # Determine whether attention is required, considering
-            # age of report, ethernet or Wi-Fi status
-            if age > 20160:
-                # Ignore if RPI age is more than 2 weeks
-                attention_needed = "IGNR"
-            elif age > 120:
-                attention_needed = "YES"
-            elif age < 120 and report["WiFi_Status"] == "DOWN":
-                attention_needed = 'MAYBE'
-            elif age < 120 and report["ETH_Status"] == "DOWN":
-                attention_needed = 'MAYBE'
-            else:
-                attention_needed = "NO"
-
-            # Format the last report time
-            report["LAST REPORT"] = format_minutes_to_human_readable(age)
-
-            # Add the attention column (make it the last column)
-            report["Attention"] = attention_needed
-
-            # Add only unique rows to reports
-            if report["RPI-ID"] not in seen:
-                seen.add(report["RPI-ID"])
-                reports.append(report)
-
-    except json.decoder.JSONDecodeError as e:
-        print("Error decoding JSON:", e)
-
-
-def main(experimental=False, timeout_sec=10, include_ignored=False):
-    global reports, rpi_ids
-    rpi_ids = firebase.get_rpi_ids()
 
+def publish_changes(reports, experimental=False, path=CHANGES_PATH):
+    """
+    Print and send only the devices whose ETH, WIFI or attention state
+    changed since the previous change-only report.
+
+    Args:
+        reports (list): Rows sorted by RPI-ID, ignored ones included.
+        experimental (bool): Only print, do not send to Slack.
+        path (string): Snapshot of the previous states.
+    """
+    states = {row.rpi_id: [row.eth, row.wifi, row.attention]
+              for row in reports}
+    # A dry run leaves the snapshot for the next real run
+    previous, diff = changes.track_changes(states, path,
+                                           save=not experimental)
+    if previous is None:
+        # First run, the full table is the baseline
+        publish_reports(reports, experimental)
+        return
+    changed, added, removed = diff
+    text = changes.summary(len(states), changed, added, removed)
+    print(text)
+    if not experimental:
+        send_slack_msg_str(text)
+
+    shown = set(changed) | set(added)
+    rows = list()
+    for row in reports:
+        if row.rpi_id in shown:
+            old = previous.get(row.rpi_id, [None] * 3)
+            rows.append([row.rpi_id, row.mac,
+                         changes.mark_change(old[0], row.eth),
+                         changes.mark_change(old[1], row.wifi),
+                         row.last_report,
+                         changes.mark_change(old[2], row.attention)])
+    if rows:
+        table = create_report_table(rows)
+        print(table)
+        if not experimental:
+            for page in paginate_table(table):
+                send_slack_msg_str(f"```{page}```")
+
+    # Only devices newly needing attention are pinged
+    alerts = [rpi_id for rpi_id in sorted(shown)
+              if states[rpi_id][2] == "YES"
+              and previous.get(rpi_id, [None] * 3)[2] != "YES"]
+    if alerts:
+        text = (f"{ATTENTION_MENTIONS}: The following RPIs now need "
+                f"attention: {', '.join(alerts)}")
+        print(text)
+        if not experimental:
+            send_slack_msg_str(text)
+
+
+def create_client(on_connect, on_message):
     # Define client and Callbacks
     client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
     client.on_connect = on_connect
@@ -189,69 +242,429 @@ def main(experimental=False, timeout_sec=10, include_ignored=False):
     config = load_mqtt_config()
     client.username_pw_set(config['username'], config['password'])
     client.connect(config['broker_addr'], int(config['broker_port']), 60)
+    return client
 
-    client.loop_start()
 
-    try:
-        # Wait for reports to be populated
-        time.sleep(timeout_sec)
+def dispatch(client, userdata, msg):
+    """
+    Forward a status message to every collector running on a shared client.
+
+    A process that owns a long-lived client calls this from its own
+    `on_message` for `topic` messages.
+    """
+    with active_lock:
+        collectors = list(active_collectors)
+    for collector in collectors:
+        collector.on_message(client, userdata, msg)
 
-        # Filter out ignored rows
-        if not include_ignored:
-            reports = [row for row in reports if row["Attention"] != "IGNR"]
 
-        # Print/send table to slack
-        report_table = create_report_table(reports)
-        report_table.sortby = "RPI-ID"
-        print(report_table)
-        if not experimental:
-            print("SENDING REPORT TABLE TO SLACK CHANNEL ...")
-            # Split data due to Slack 3000-characters limit
-            table_size = len(report_table.rows)
-            start_idx = 0
-            for i in range(1, table_size + 1):
-                temp_table = report_table[start_idx:i]
-                if (i == table_size
-                        or len(temp_table.get_string()) > 2800):
-                    start_idx = i
-                    send_slack_msg_str(
-                        f"```{temp_table.get_string()}```")
-
-        # Generate the attention table (list of devices needing  attention)
-        attn_table = create_report_table(
-            [row for row in reports if row["Attention"] == "YES"])
-        attn_table.sortby = "RPI-ID"
-        if (len(attn_table.rows) > 0):
-            print(f"Attention table:\n{attn_table}")
-            if not experimental:
-                print("SENDING ATTN TABLE TO SLACK CHANNEL ...")
-                send_slack_msg_str(
-                    "<@U048TQS3XUK> <@U05QKN65PEY>: The following RPIs need "
-                    "attention.")
-                # Split data due to Slack 3000-characters limit
-                table_size = len(attn_table.rows)
-                start_idx = 0
-                for i in range(1, table_size + 1):
-                    temp_table = attn_table[start_idx:i]
-                    if (i == table_size
-                            or len(temp_table.get_string()) > 2800):
-                        start_idx = i
-                        send_slack_msg_str(
-                            f"```{temp_table.get_string()}```")
+class FleetCollector:
+    """
+    Collect one round of status reports from the fleet.
 
+    All state lives on the instance, so collectors can run repeatedly or in
+    parallel in one process, each on its own client or on a shared one.
+
+    Collection completes as soon as every expected MAC has reported, or once
+    no message arrived for `quiet_sec` seconds after subscribing. Reports
+    are also appended to `store` when given.
+    """
+
+    def __init__(self, rpi_ids, quiet_sec=QUIET_SEC, store=None):
+        self.rpi_ids = rpi_ids
+        self.quiet_sec = quiet_sec
+        self.store = store
+        self.state = FleetState()
+        # MACs expected to report and MACs that reported so far
+        self.expected_macs = {mac for mac, rpi_id in rpi_ids.items()
+                              if rpi_id.startswith("RPI-")}
+        self.reported_macs = set()
+        # Monotonic time of the subscription or of the last message
+        self.last_activity = None
+        self._cond = threading.Condition()
+        # (loop, asyncio.Event) of a wait_async in progress
+        self._wakeup = None
+
+    def mark_activity(self, mac=None):
+        with self._cond:
+            self.last_activity = time.monotonic()
+            if mac is not None:
+                self.reported_macs.add(mac)
+            self._cond.notify_all()
+            if self._wakeup is not None:
+                loop, event = self._wakeup
+                loop.call_soon_threadsafe(event.set)
+
+    def _check(self, deadline):
+        """
+        Return the reason the collection is over, or None and the seconds
+        to wait before checking again. Called with the lock held.
+        """
+        now = time.monotonic()
+        if self.expected_macs and self.expected_macs <= self.reported_macs:
+            return "complete", None
+        if now >= deadline:
+            return "timeout", None
+        wait_sec = deadline - now
+        if self.quiet_sec and self.last_activity is not None:
+            quiet_left = self.last_activity + self.quiet_sec - now
+            if quiet_left <= 0:
+                return "quiet", None
+            wait_sec = min(wait_sec, quiet_left)
+        return None, wait_sec
+
+    def wait(self, timeout_sec):
+        """
+        Block until the collection is complete, `timeout_sec` is a hard upper
+        bound.
+
+        Returns:
+            str: The reason the wait ended: "complete", "quiet" or "timeout".
+        """
+        deadline = time.monotonic() + timeout_sec
+        with self._cond:
+            while True:
+                reason, wait_sec = self._check(deadline)
+                if reason is not None:
+                    return reason
+                self._cond.wait(wait_sec)
+
+    async def wait_async(self, timeout_sec):
+        """
+        Like `wait`, without blocking the running event loop.
+        """
+        deadline = time.monotonic() + timeout_sec
+        event = asyncio.Event()
+        with self._cond:
+            self._wakeup = (asyncio.get_running_loop(), event)
+        try:
+            while True:
+                event.clear()
+                with self._cond:
+                    reason, wait_sec = self._check(deadline)
+                if reason is not None:
+                    return reason
+                try:
+                    await asyncio.wait_for(event.wait(), wait_sec)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self._wakeup = None
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            print("------------Connected successfully, please wait for the "
+                  "results -------------")
+        client.subscribe(topic, qos=1)
+        # Start the quiet period from the subscription
+        self.mark_activity()
+
+    # The Callback function to execute whenever messages are received
+    def on_message(self, client, userdata, msg):
+        start = time.perf_counter()
+        metrics.MQTT_RECEIVED.inc(tool="pi-monitor", topic="status")
+        pi_mac = payloads.topic_mac(msg.topic)
+        try:
+            retained_msg = payloads.decode(msg, payloads.STATUS,
+                                           known_macs=self.expected_macs)
+            # Extract the timestamp and interface state
+            status = parse_status(retained_msg)
+            if self.store is not None:
+                self.store.append(pi_mac, *status)
+            # Keep the first report of each device
+            with self._cond:
+                if pi_mac not in self.state:
+                    self.state.update(pi_mac, retained_msg["mac"], *status)
+
+        except payloads.PayloadError as e:
+            if e.reason != "unknown_mac":
+                print("Error decoding status:", e)
+            metrics.MQTT_DISCARDED.inc(tool="pi-monitor", reason=e.reason)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            # Must not escape into the network thread of a shared client
+            print("Error decoding status:", e)
+            metrics.MQTT_DISCARDED.inc(tool="pi-monitor", reason="parse")
+
+        finally:
+            self.mark_activity(pi_mac)
+            metrics.MESSAGE_SECONDS.observe(time.perf_counter() - start,
+                                            tool="pi-monitor", type="status")
+
+    def run(self, timeout_sec=10, client=None):
+        """
+        Collect the reports.
+
+        Args:
+            timeout_sec (int): Hard upper bound on the collection time.
+            client (mqtt.Client): Connected client to reuse. Its owner must
+                forward status messages to `dispatch`. A new client is
+                connected and torn down if None.
+
+        Returns:
+            The collected report rows, sorted by RPI-ID.
+        """
+        start = time.perf_counter()
+        if client is None:
+            client = create_client(self.on_connect, self.on_message)
+            client.loop_start()
+            try:
+                reason = self.wait(timeout_sec)
+            finally:
+                print("Disconnecting from the broker ...")
+                client.disconnect()
+                client.loop_stop()
         else:
-            print("ALL GOOD! No node needs attention right now.")
-            if not experimental:
-                send_slack_msg_str(
-                    "ALL GOOD! No node needs attention right now.")
+            with active_lock:
+                active_collectors.add(self)
+            try:
+                # Re-subscribing makes the broker resend retained messages
+                client.subscribe(topic, qos=1)
+                self.mark_activity()
+                reason = self.wait(timeout_sec)
+            finally:
+                with active_lock:
+                    active_collectors.discard(self)
+
+        return self._finish(reason, start)
+
+    async def run_async(self, client, timeout_sec=10):
+        """
+        Collect the reports on a shared client without blocking the running
+        event loop, see `run`.
+        """
+        start = time.perf_counter()
+        with active_lock:
+            active_collectors.add(self)
+        try:
+            # Re-subscribing makes the broker resend retained messages
+            client.subscribe(topic, qos=1)
+            self.mark_activity()
+            reason = await self.wait_async(timeout_sec)
+        finally:
+            with active_lock:
+                active_collectors.discard(self)
+        return self._finish(reason, start)
+
+    def _finish(self, reason, start):
+        metrics.COLLECTOR_SECONDS.observe(time.perf_counter() - start,
+                                          reason=reason)
+        with self._cond:
+            print(f"Collection finished ({reason}): "
+                  f"{len(self.reported_macs & self.expected_macs)} of "
+                  f"{len(self.expected_macs)} devices reported")
+            return build_reports(self.state, self.rpi_ids)
+
+
+class FleetDaemon:
+    """
+    Watch the fleet continuously and alert on attention changes.
+
+    One subscription keeps the latest status of every device. Devices
+    without a report for more than 2 hours raise a stale alert, and devices
+    with an interface down raise an interface alert once debounced. Alerts
+    are sent on their raising and clearing edges only, and a digest of the
+    fleet is posted every `digest_sec` seconds instead of the full tables.
+
+    Staleness deadlines are kept on a timer wheel, so each evaluation only
+    looks at the devices that reported, crossed a deadline or are debouncing
+    an interface change since the previous one, not at the whole fleet.
+    """
+
+    def __init__(self, experimental=False, eval_sec=EVAL_SEC,
+                 digest_sec=DIGEST_SEC, store=None):
+        self.experimental = experimental
+        self.eval_sec = eval_sec
+        self.digest_sec = digest_sec
+        self.store = store
+        self.state = FleetState()
+        self.index = StalenessIndex()
+        self.stale = alerts.AlertTracker(cooldown=ALERT_COOLDOWN_SEC)
+        self.iface = alerts.AlertTracker(IFACE_DEBOUNCE_SEC, IFACE_CLEAR_SEC,
+                                         ALERT_COOLDOWN_SEC)
+        self.primed = False
+        # Devices reported since the last evaluation: recovered thresholds
+        self._reported = dict()
+        # Interface condition of the latest report of each device
+        self._iface_bad = dict()
+        # Devices whose interface alert is debouncing
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def send(self, text):
+        print(text)
+        if not self.experimental:
+            send_slack_msg_str(text)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            print("Connected, watching the fleet")
+        client.subscribe(topic, qos=1)
+
+    def on_message(self, client, userdata, msg):
+        start = time.perf_counter()
+        metrics.MQTT_RECEIVED.inc(tool="pi-monitor", topic="status")
+        pi_mac = payloads.topic_mac(msg.topic)
+        try:
+            retained_msg = payloads.decode(msg, payloads.STATUS)
+            status = parse_status(retained_msg)
+            if self.store is not None:
+                self.store.append(pi_mac, *status)
+            report_time = status[0].timestamp()
+            # Keep the latest report of each device
+            with self._lock:
+                self.state.update(pi_mac, retained_msg["mac"], *status)
+                last_seen = self.index.last_seen(pi_mac)
+                if last_seen is None or report_time > last_seen:
+                    recovered = self.index.seen(pi_mac, report_time)
+                    self._reported.setdefault(pi_mac, set()).update(
+                        recovered)
+                    self._iface_bad[pi_mac] = not all(status[1:])
+        except (payloads.PayloadError, KeyError, TypeError, ValueError,
+                AttributeError) as e:
+            print("Error decoding status:", e)
+            metrics.MQTT_DISCARDED.inc(tool="pi-monitor", reason="parse")
+        finally:
+            metrics.MESSAGE_SECONDS.observe(time.perf_counter() - start,
+                                            tool="pi-monitor", type="status")
+
+    def evaluate(self, now=None, current_time=None):
+        """
+        Send the alerts that changed state since the previous evaluation.
+
+        The first evaluation only records the current state, which the
+        first digest reports.
+
+        Args:
+            now (float): Monotonic time of the alert trackers.
+            current_time (float): UNIX time that report ages count to.
+        """
+        if now is None:
+            now = time.monotonic()
+        if current_time is None:
+            current_time = time.time()
+        with self._lock:
+            crossed = self.index.advance(current_time)
+            reported, self._reported = self._reported, dict()
+            # Recoveries first, so that a report already stale when it
+            # arrived ends up stale
+            stale = {pi_mac: False
+                     for pi_mac, recovered in reported.items() if recovered}
+            ignored = set()
+            for pi_mac, threshold in crossed:
+                if threshold == STALE_SEC:
+                    stale[pi_mac] = True
+                else:
+                    ignored.add(pi_mac)
+            for pi_mac in ignored:
+                stale.pop(pi_mac, None)
+            for pi_mac in reported:
+                age = current_time - self.index.last_seen(pi_mac)
+                if age < STALE_SEC:
+                    self._pending.add(pi_mac)
+            # Interfaces are unknown while the report is stale
+            self._pending.difference_update(
+                pi_mac for pi_mac, bad in stale.items() if bad)
+            self._pending -= ignored
+            iface = {pi_mac: self._iface_bad[pi_mac]
+                     for pi_mac in self._pending}
+
+        edges = {alerts.RAISE: list(), alerts.CLEAR: list()}
+        for tracker, reason, conditions in (
+                (self.stale, "no recent report", stale),
+                (self.iface, "interface down", iface)):
+            for pi_mac, bad in conditions.items():
+                rpi_id = firebase.get_rpi_id_from_mac(pi_mac)
+                if rpi_id is None or not rpi_id.startswith("RPI-"):
+                    self._pending.discard(pi_mac)
+                    continue
+                if not self.primed:
+                    tracker.prime(rpi_id, bad, now)
+                else:
+                    edge = tracker.update(rpi_id, bad, now)
+                    if edge is not None:
+                        edges[edge].append(f"{rpi_id} ({reason})")
+                        metrics.ALERTS.inc(kind=reason, action=edge)
+                if tracker is self.iface and tracker.settled(rpi_id):
+                    self._pending.discard(pi_mac)
+        # Ignored devices drop their alerts silently
+        for pi_mac in ignored:
+            rpi_id = firebase.get_rpi_id_from_mac(pi_mac)
+            if rpi_id is not None:
+                self.stale.prime(rpi_id, False, now)
+                self.iface.prime(rpi_id, False, now)
+        self.primed = True
+
+        if edges[alerts.RAISE]:
+            self.send(f"{ATTENTION_MENTIONS}: The following RPIs need "
+                      f"attention: {', '.join(edges[alerts.RAISE])}")
+        if edges[alerts.CLEAR]:
+            self.send(f"Recovered: {', '.join(edges[alerts.CLEAR])}")
+
+    def digest(self):
+        """
+        Send a compact summary of the fleet and of the active alerts.
+        """
+        rpi_ids = firebase.get_rpi_ids()
+        with self._lock:
+            reports = build_reports(self.state, rpi_ids)
+        counts = dict()
+        for row in reports:
+            counts[row.attention] = counts.get(row.attention, 0) + 1
+        lines = [f"Fleet digest: {len(reports)} devices, " + ", ".join(
+            f"{counts.get(level, 0)} {level}"
+            for level in ("NO", "MAYBE", "YES", "IGNR"))]
+        stale = self.stale.active()
+        if stale:
+            lines.append(f"No recent report: {', '.join(stale)}")
+        down = self.iface.active()
+        if down:
+            lines.append(f"Interface down: {', '.join(down)}")
+        self.send("\n".join(lines))
+
+    def run(self):
+        client = create_client(self.on_connect, self.on_message)
+        client.loop_start()
+        next_digest = time.monotonic() + self.eval_sec
+        try:
+            while True:
+                time.sleep(self.eval_sec)
+                self.evaluate()
+                if time.monotonic() >= next_digest:
+                    self.digest()
+                    next_digest = time.monotonic() + self.digest_sec
+        except KeyboardInterrupt:
+            print("\nKeyboard Interrupt !")
+        finally:
+            print("Disconnecting from the broker ...")
+            client.disconnect()
+            client.loop_stop()
+            slack_sender.webhook_sender().flush()
+
+
+def main(experimental=False, timeout_sec=10, include_ignored=False,
+         quiet_sec=QUIET_SEC, client=None, metrics_file=None, store=None,
+         changes_only=False):
+    # Start from the last-known registry, Firebase is reconciled in background
+    firebase.registry.warm_start()
+    collector = FleetCollector(firebase.get_rpi_ids(), quiet_sec, store)
+
+    try:
+        # Wait for reports to be populated
+        reports = collector.run(timeout_sec, client)
+        if changes_only:
+            publish_changes(reports, experimental)
+        else:
+            publish_reports(reports, experimental, include_ignored)
+        # Wait for the queued Slack messages to be delivered
+        slack_sender.webhook_sender().flush()
 
     except KeyboardInterrupt:
         print("\nKeyboard Interrupt !")
 
     finally:
-        print("Disconnecting from the broker ...")
-        client.disconnect()
-        client.loop_stop()
+        if metrics_file:
+            metrics.dump(metrics_file)
 
 
 # Main script combining all the components
@@ -264,5 +677,46 @@ if __name__ == '__main__':
     parser.add_argument("--timeout", type=int, default=10,
                         help=("Timeout to wait for reports in seconds, "
                               "default=10s"))
+    parser.add_argument("--quiet", type=float, default=QUIET_SEC,
+                        help=("Stop waiting after this many seconds without "
+                              "new reports, 0 to disable, "
+                              f"default={QUIET_SEC}s"))
+    parser.add_argument("--metrics-file",
+                        help="Write Prometheus metrics to this file on exit")
+    parser.add_argument("--store", default=STORE_PATH,
+                        help=("Append the reports to this status history, "
+                              f"empty to disable, default={STORE_PATH}"))
+    parser.add_argument("--changes-only", action="store_true",
+                        help=("Only report the devices whose state changed "
+                              "since the last --changes-only run"))
+    parser.add_argument("--daemon", action="store_true",
+                        help=("Keep running, alert when devices need "
+                              "attention and post periodic digests"))
+    parser.add_argument("--eval-interval", type=int, default=EVAL_SEC,
+                        help=("Daemon seconds between fleet evaluations, "
+                              f"default={EVAL_SEC}"))
+    parser.add_argument("--digest-interval", type=int, default=DIGEST_SEC,
+                        help=("Daemon seconds between digests, "
+                              f"default={DIGEST_SEC}"))
     args = parser.parse_args()
-    main(args.experimental, args.timeout, args.include_ignored)
+    store = StatusStore(args.store) if args.store else None
+    try:
+        if args.daemon:
+            # Keep the registry fresh for the lifetime of the process
+            firebase.registry.warm_start(reconcile=False)
+            firebase.registry.start_listener()
+            try:
+                FleetDaemon(args.experimental, args.eval_interval,
+                            args.digest_interval, store).run()
+            finally:
+                firebase.registry.stop_listener()
+                if args.metrics_file:
+                    metrics.dump(args.metrics_file)
+        else:
+            main(args.experimental, args.timeout, args.include_ignored,
+                 args.quiet, metrics_file=args.metrics_file, store=store,
+                 changes_only=args.changes_only)
+    finally:
+        if store is not None:
+            # Commit the queued reports
+            store.close()
@@ -0,0 +1,311 @@
+import gzip
+import json
+import logging
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+import requests
+
+import metrics
+
+# Slack accepts at most 50 blocks per message, keep merged posts well under
+# the message size limit too
+MAX_BLOCKS = 50
+MAX_CHARS = 12000
+MAX_RETRIES = 5
+# Backoff when a 429 response carries no Retry-After header
+DEFAULT_RETRY_AFTER = 1.0
+# File uploads running at once, each holds an HTTP connection and a spool
+MAX_UPLOADS = 2
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+_config = None
+_config_lock = threading.Lock()
+_webhook_sender = None
+
+
+def load_slack_config():
+    """
+    Load `.slack-config.json` once and return the cached dict.
+    """
+    global _config
+    with _config_lock:
+        if _config is None:
+            with open('.slack-config.json', 'r') as file:
+                _config = json.load(file)
+    return _config
+
+
+class RateLimited(Exception):
+    """
+    Raised by a poster when Slack answers 429 Too Many Requests.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _retry_after(headers):
+    try:
+        return float(headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+class WebhookPoster:
+    """
+    Post blocks to an incoming webhook URL over a persistent HTTP session.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+
+    def __call__(self, url, blocks):
+        response = self.session.post(url, json={"blocks": blocks})
+        if response.status_code == 429:
+            raise RateLimited(_retry_after(response.headers))
+        response.raise_for_status()
+        return response.text
+
+
+class WebClientPoster:
+    """
+    Post blocks with `chat.postMessage` through a Slack WebClient.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __call__(self, channel, blocks, **kwargs):
+        from slack_sdk.errors import SlackApiError
+        try:
+            return self.client.chat_postMessage(
+                channel=channel, blocks=blocks, **kwargs)
+        except SlackApiError as e:
+            if e.response is not None and e.response.status_code == 429:
+                raise RateLimited(_retry_after(e.response.headers))
+            raise
+
+
+class SlackSender:
+    """
+    Ordered, rate-limit-aware delivery of Slack messages.
+
+    Messages are queued per channel and posted in order by one worker thread
+    per channel. Consecutive messages with the same options are merged into a
+    single post while they fit in `max_blocks` and `max_chars`. A 429 answer
+    pauses the channel for its Retry-After delay and retries the same post.
+    """
+
+    def __init__(self, post, max_blocks=MAX_BLOCKS, max_chars=MAX_CHARS,
+                 max_retries=MAX_RETRIES):
+        self.post = post
+        self.max_blocks = max_blocks
+        self.max_chars = max_chars
+        self.max_retries = max_retries
+        self.posts = 0
+        self.messages = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self._queues = dict()
+        self._lock = threading.Lock()
+
+    def send(self, channel, blocks, **kwargs):
+        """
+        Queue blocks to be posted to a channel.
+
+        Args:
+            channel (string): Channel ID, or URL for webhooks.
+            blocks (list): Slack blocks.
+            **kwargs: Extra post options such as `username`.
+        """
+        with self._lock:
+            channel_queue = self._queues.get(channel)
+            if channel_queue is None:
+                channel_queue = queue.Queue()
+                self._queues[channel] = channel_queue
+                threading.Thread(target=self._worker,
+                                 args=(channel, channel_queue),
+                                 daemon=True).start()
+        channel_queue.put((blocks, kwargs))
+
+    def flush(self):
+        """
+        Block until every queued message has been posted or dropped.
+        """
+        with self._lock:
+            queues = list(self._queues.values())
+        for channel_queue in queues:
+            channel_queue.join()
+
+    def stats(self):
+        return {
+            "messages": self.messages,
+            "posts": self.posts,
+            "rate_limited": self.rate_limited,
+            "failures": self.failures,
+        }
+
+    def _size(self, blocks):
+        return sum(len(block.get("text", {}).get("text", ""))
+                   for block in blocks)
+
+    def _worker(self, channel, channel_queue):
+        pending = None
+        while True:
+            if pending is None:
+                pending = channel_queue.get()
+            blocks, kwargs = pending
+            blocks = list(blocks)
+            count = 1
+            size = self._size(blocks)
+            pending = None
+            # Merge the following messages while they share the options
+            while True:
+                try:
+                    item = channel_queue.get_nowait()
+                except queue.Empty:
+                    break
+                item_size = self._size(item[0])
+                if (item[1] != kwargs
+                        or len(blocks) + len(item[0]) > self.max_blocks
+                        or size + item_size > self.max_chars):
+                    pending = item
+                    break
+                blocks.extend(item[0])
+                size += item_size
+                count += 1
+            self._post(channel, blocks, kwargs)
+            with self._lock:
+                self.messages += count
+            for i in range(count):
+                channel_queue.task_done()
+
+    def _post(self, channel, blocks, kwargs):
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                result = self.post(channel, blocks, **kwargs)
+                metrics.SLACK_SECONDS.observe(time.perf_counter() - start,
+                                              result="ok")
+                with self._lock:
+                    self.posts += 1
+                logging.debug("Slack post result: %s", result)
+                return
+            except RateLimited as e:
+                metrics.SLACK_FAILURES.inc(reason="rate_limited")
+                with self._lock:
+                    self.rate_limited += 1
+                logging.warning("Slack rate limited, retrying in %.1fs",
+                                e.retry_after)
+                time.sleep(e.retry_after)
+            except Exception as e:
+                metrics.SLACK_SECONDS.observe(time.perf_counter() - start,
+                                              result="error")
+                metrics.SLACK_FAILURES.inc(reason="error")
+                with self._lock:
+                    self.failures += 1
+                logging.error(f"Error posting message: {e}")
+                return
+        metrics.SLACK_FAILURES.inc(reason="retries")
+        with self._lock:
+            self.failures += 1
+        logging.error("Giving up posting message after %d retries",
+                      self.max_retries)
+
+
+class FileUploader:
+    """
+    Stream files to Slack through the external upload flow.
+
+    The file is sent with `files.getUploadURLExternal`, a streamed POST of
+    its content and `files.completeUploadExternal`, so it is never held in
+    memory. At most `max_uploads` uploads run at once, and with `compress`
+    the file is gzipped to a temporary file first.
+    """
+
+    def __init__(self, client, max_uploads=MAX_UPLOADS, compress=False):
+        self.client = client
+        self.compress = compress
+        self.uploads = 0
+        self.failures = 0
+        self.session = requests.Session()
+        self._slots = threading.BoundedSemaphore(max_uploads)
+        self._lock = threading.Lock()
+
+    def _compressed(self, file):
+        compressed = tempfile.TemporaryFile(prefix="upload-")
+        with gzip.GzipFile(fileobj=compressed, mode="wb") as gz:
+            shutil.copyfileobj(file, gz, UPLOAD_CHUNK_BYTES)
+        compressed.seek(0)
+        return compressed
+
+    def upload(self, channel, file, filename, title):
+        """
+        Upload the whole content of a seekable binary file object.
+
+        Returns:
+            True if Slack accepted the file.
+        """
+        with self._slots:
+            start = time.perf_counter()
+            compressed = None
+            try:
+                if self.compress:
+                    file = compressed = self._compressed(file)
+                    filename += ".gz"
+                file.seek(0, 2)
+                length = file.tell()
+                file.seek(0)
+                ticket = self.client.files_getUploadURLExternal(
+                    filename=filename, length=length)
+                # requests sets Content-Length from the file size and
+                # streams the file in blocks
+                response = self.session.post(ticket["upload_url"], data=file)
+                response.raise_for_status()
+                self.client.files_completeUploadExternal(
+                    files=[{"id": ticket["file_id"], "title": title}],
+                    channel_id=channel)
+            except Exception as e:
+                metrics.SLACK_SECONDS.observe(time.perf_counter() - start,
+                                              result="error")
+                metrics.SLACK_FAILURES.inc(reason="upload")
+                with self._lock:
+                    self.failures += 1
+                logging.error(f"Error uploading file: {e}")
+                return False
+            finally:
+                if compressed is not None:
+                    compressed.close()
+        metrics.SLACK_SECONDS.observe(time.perf_counter() - start,
+                                      result="upload")
+        with self._lock:
+            self.uploads += 1
+        logging.info("Uploaded %s, %d bytes", filename, length)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"uploads": self.uploads, "failures": self.failures}
+
+
+def webhook_sender():
+    """
+    Return the process-wide sender for the configured webhook URL.
+    """
+    global _webhook_sender
+    with _config_lock:
+        if _webhook_sender is None:
+            _webhook_sender = SlackSender(WebhookPoster())
+    return _webhook_sender
+
+
+def send_webhook_blocks(blocks):
+    """
+    Queue blocks for the webhook URL in `.slack-config.json`.
+    """
+    webhook_sender().send(load_slack_config()['url'], blocks)
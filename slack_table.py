@@ -0,0 +1,75 @@
+# Split PrettyTable tables into pages that fit in a Slack message
+#
+# A page is closed by the first row that makes its rendered table longer than
+# `limit`, that row included, exactly like the former add-a-row-and-render
+# loops. Instead of rendering every growing prefix, the rendered length of a
+# page is tracked from the running column widths, so every row is measured
+# once and every page is rendered once.
+
+# Slack section text is limited to 3000 characters, leave room for markup
+SLACK_TABLE_LIMIT = 2800
+
+
+def _row_cells(row):
+    cells = [str(value).split("\n") for value in row]
+    widths = [max(len(line) for line in lines) for lines in cells]
+    height = max(len(lines) for lines in cells)
+    return widths, height
+
+
+def _page_length(widths, height, title):
+    # Every line has the same length: cell widths, one padding space each
+    # side and a vertical rule between and around the cells
+    line_length = sum(widths) + 3 * len(widths) + 1
+    # Borders, header and header separator, plus title box if any
+    line_count = height + 4 + (2 if title else 0)
+    return line_count * line_length + line_count - 1
+
+
+def paginate_table(table, limit=SLACK_TABLE_LIMIT, keep_empty=False):
+    """
+    Yield the rendered pages of a table.
+
+    Args:
+        table (PrettyTable): Table to split, its options (sortby, title...)
+            apply to every page.
+        limit (int): A page is closed once its length exceeds this.
+        keep_empty (bool): Also yield the trailing page when it is empty.
+
+    Yields:
+        str: Rendered page.
+    """
+    rows = table.rows
+    title = table.title
+    header_widths = [len(name) for name in table.field_names]
+    exact = True
+
+    start = 0
+    widths = list(header_widths)
+    height = 0
+    for i, row in enumerate(rows, 1):
+        if exact:
+            row_widths, row_height = _row_cells(row)
+            widths = [max(w, rw) for w, rw in zip(widths, row_widths)]
+            height += row_height
+            predicted = _page_length(widths, height, title)
+            if predicted <= limit:
+                continue
+            page = table[start:i].get_string()
+            if len(page) != predicted:
+                # Formatting the model does not cover (wide characters,
+                # custom styles...), measure by rendering from here on
+                exact = False
+                if len(page) <= limit:
+                    continue
+        else:
+            page = table[start:i].get_string()
+            if len(page) <= limit:
+                continue
+        yield page
+        start = i
+        widths = list(header_widths)
+        height = 0
+
+    if start < len(rows) or keep_empty:
+        yield table[start:].get_string()
@@ -0,0 +1,146 @@
+# Last-seen index with staleness deadlines on a hashed timer wheel
+#
+# Each device has at most one wheel entry per threshold. A new report only
+# moves the device's last-seen time. When an entry comes due, it is either
+# rescheduled to the device's current deadline, or reported as crossing its
+# threshold. Reports and ticks are O(1) amortized: an entry fires at most
+# once per threshold period of its device, plus once per wheel revolution.
+import threading
+import time
+
+from fleet_state import STALE_AGE_MIN, IGNORE_AGE_MIN
+
+# Report ages at which a device needs attention and is ignored, in seconds
+STALE_SEC = STALE_AGE_MIN * 60
+IGNORE_SEC = IGNORE_AGE_MIN * 60
+THRESHOLDS = (STALE_SEC, IGNORE_SEC)
+RESOLUTION_SEC = 60
+# 4096 one-minute slots make one revolution about every 68 hours
+WHEEL_SLOTS = 4096
+
+
+class Device:
+    __slots__ = ("last_seen", "scheduled", "crossed")
+
+    def __init__(self, last_seen):
+        self.last_seen = last_seen
+        # Bit per threshold index: entry on the wheel, threshold crossed
+        self.scheduled = 0
+        self.crossed = 0
+
+
+class StalenessIndex:
+    """
+    Detect devices crossing report-age thresholds without scanning them.
+
+    Times are UNIX timestamps, so that the age of a retained report counts
+    from when it was published.
+    """
+
+    def __init__(self, thresholds=THRESHOLDS, resolution_sec=RESOLUTION_SEC,
+                 slots=WHEEL_SLOTS, now=None):
+        self.thresholds = tuple(thresholds)
+        self.resolution_sec = resolution_sec
+        self.slots = slots
+        self._devices = dict()
+        self._wheel = [list() for _ in range(slots)]
+        # Entries already due when scheduled, for the next advance
+        self._due = list()
+        if now is None:
+            now = time.time()
+        # Last tick processed
+        self._cursor = int(now // resolution_sec)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def _schedule(self, deadline, key, level):
+        tick = int(deadline // self.resolution_sec)
+        if tick <= self._cursor:
+            self._due.append((tick, key, level))
+        else:
+            self._wheel[tick % self.slots].append((tick, key, level))
+
+    def seen(self, key, when):
+        """
+        Record a report of a device.
+
+        Args:
+            key: Device key, such as its topic MAC.
+            when (float): UNIX time of the report.
+
+        Returns:
+            The thresholds the device was past and no longer is.
+        """
+        with self._lock:
+            device = self._devices.get(key)
+            if device is None:
+                device = self._devices[key] = Device(when)
+            elif when <= device.last_seen:
+                # An older report, such as a retained message redelivered
+                return []
+            device.last_seen = when
+            recovered = [threshold
+                         for level, threshold in enumerate(self.thresholds)
+                         if device.crossed & 1 << level]
+            device.crossed = 0
+            for level, threshold in enumerate(self.thresholds):
+                if not device.scheduled & 1 << level:
+                    device.scheduled |= 1 << level
+                    self._schedule(when + threshold, key, level)
+            return recovered
+
+    def forget(self, key):
+        with self._lock:
+            # Its wheel entries are dropped when they come due
+            self._devices.pop(key, None)
+
+    def last_seen(self, key):
+        device = self._devices.get(key)
+        return device.last_seen if device is not None else None
+
+    def advance(self, now=None):
+        """
+        Process the wheel up to `now`.
+
+        Returns:
+            (key, threshold) pairs of the devices that crossed a threshold,
+            by increasing threshold.
+        """
+        if now is None:
+            now = time.time()
+        target = int(now // self.resolution_sec)
+        crossed = list()
+        with self._lock:
+            # After a long pause, one revolution visits every entry
+            first = max(self._cursor + 1, target - self.slots + 1)
+            self._cursor = max(self._cursor, target)
+            due, self._due = self._due, list()
+            buckets = [due]
+            for tick in range(first, target + 1):
+                bucket = self._wheel[tick % self.slots]
+                if bucket:
+                    # Entries of later revolutions stay in the bucket
+                    self._wheel[tick % self.slots] = [
+                        entry for entry in bucket if entry[0] > target]
+                    buckets.append(bucket)
+            for bucket in buckets:
+                for entry_tick, key, level in bucket:
+                    if entry_tick > target:
+                        continue
+                    device = self._devices.get(key)
+                    if (device is None
+                            or not device.scheduled & 1 << level):
+                        # Forgotten, or a duplicate after forget and seen
+                        continue
+                    deadline = device.last_seen + self.thresholds[level]
+                    if deadline > now:
+                        # Seen since this entry was scheduled
+                        self._schedule(deadline, key, level)
+                    else:
+                        device.scheduled &= ~(1 << level)
+                        device.crossed |= 1 << level
+                        crossed.append((key, self.thresholds[level]))
+        crossed.sort(key=lambda pair: pair[1])
+        return crossed
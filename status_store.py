@@ -0,0 +1,257 @@
+# History of the device status reports
+#
+# Every `report/status` message seen by the monitors is appended to a local
+# SQLite database in WAL mode, keyed by (topic MAC, report time). Writes are
+# queued and committed in batches by a writer thread. Raw samples older than
+# RAW_RETENTION_DAYS are downsampled to hourly rows, which are kept for
+# HOURLY_RETENTION_DAYS.
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+STORE_PATH = ".status-history.db"
+BATCH_SIZE = 500
+# Longest a queued sample waits before being committed
+FLUSH_SEC = 1.0
+RAW_RETENTION_DAYS = 14
+HOURLY_RETENTION_DAYS = 365
+COMPACT_INTERVAL_SEC = 3600
+HOUR_SEC = 3600
+DAY_SEC = 86400
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS status (
+    mac TEXT NOT NULL,
+    ts REAL NOT NULL,
+    eth INTEGER NOT NULL,
+    wlan INTEGER NOT NULL,
+    PRIMARY KEY (mac, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS status_hourly (
+    mac TEXT NOT NULL,
+    hour REAL NOT NULL,
+    samples INTEGER NOT NULL,
+    eth_up INTEGER NOT NULL,
+    wlan_up INTEGER NOT NULL,
+    PRIMARY KEY (mac, hour)
+) WITHOUT ROWID;
+"""
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _to_datetime(ts):
+    return datetime.fromtimestamp(ts, timezone.utc)
+
+
+def _to_ts(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return value.timestamp()
+
+
+class StatusStore:
+    """
+    Append-only store of status samples with a query API.
+
+    `append` only queues the sample, so it is cheap to call from MQTT
+    callbacks. Queries open their own connection and may run from any
+    thread while the writer is committing.
+    """
+
+    def __init__(self, path=STORE_PATH, batch_size=BATCH_SIZE,
+                 flush_sec=FLUSH_SEC, raw_retention_days=RAW_RETENTION_DAYS,
+                 hourly_retention_days=HOURLY_RETENTION_DAYS):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_sec = flush_sec
+        self.raw_retention_days = raw_retention_days
+        self.hourly_retention_days = hourly_retention_days
+        self.written = 0
+        conn = _connect(path)
+        with conn:
+            conn.executescript(SCHEMA)
+        conn.close()
+        self._queue = queue.Queue()
+        self._last_compact = 0.0
+        self._thread = threading.Thread(target=self._write_loop,
+                                        name="status-store", daemon=True)
+        self._thread.start()
+
+    def append(self, pi_mac, last_msg_time, is_eth_up, is_wlan_up):
+        self._queue.put((pi_mac, last_msg_time.timestamp(), int(is_eth_up),
+                         int(is_wlan_up)))
+
+    def flush(self):
+        """
+        Block until every queued sample is committed.
+        """
+        self._queue.join()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write_loop(self):
+        conn = _connect(self.path)
+        running = True
+        while running:
+            batch = list()
+            try:
+                item = self._queue.get(timeout=self.flush_sec)
+            except queue.Empty:
+                item = False
+            deadline = time.monotonic() + self.flush_sec
+            while item:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if item is None:
+                running = False
+            try:
+                if batch:
+                    with conn:
+                        conn.executemany("INSERT OR IGNORE INTO status "
+                                         "VALUES (?, ?, ?, ?)", batch)
+                    self.written += len(batch)
+                if time.monotonic() - self._last_compact > \
+                        COMPACT_INTERVAL_SEC:
+                    self._compact(conn)
+            except sqlite3.Error as e:
+                logging.error("Cannot write status history: %s", e)
+            finally:
+                for _ in range(len(batch) + (item is None)):
+                    self._queue.task_done()
+        conn.close()
+
+    def _compact(self, conn, now=None):
+        if now is None:
+            now = time.time()
+        self._last_compact = time.monotonic()
+        raw_cutoff = now - self.raw_retention_days * DAY_SEC
+        # Only whole hours are downsampled, so an hour is never split
+        raw_cutoff -= raw_cutoff % HOUR_SEC
+        with conn:
+            conn.execute(
+                "INSERT INTO status_hourly "
+                "SELECT mac, CAST(ts / ? AS INTEGER) * ? AS hour, count(*), "
+                "sum(eth), sum(wlan) FROM status WHERE ts < ? "
+                "GROUP BY mac, hour "
+                "ON CONFLICT (mac, hour) DO UPDATE SET "
+                "samples = samples + excluded.samples, "
+                "eth_up = eth_up + excluded.eth_up, "
+                "wlan_up = wlan_up + excluded.wlan_up",
+                (HOUR_SEC, HOUR_SEC, raw_cutoff))
+            conn.execute("DELETE FROM status WHERE ts < ?", (raw_cutoff,))
+            conn.execute("DELETE FROM status_hourly WHERE hour < ?",
+                         (now - self.hourly_retention_days * DAY_SEC,))
+
+    def compact(self, now=None):
+        """
+        Downsample and expire old samples now instead of waiting for the
+        writer.
+        """
+        self.flush()
+        conn = _connect(self.path)
+        try:
+            self._compact(conn, _to_ts(now))
+        finally:
+            conn.close()
+
+    def _query(self, sql, params):
+        conn = _connect(self.path)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def history(self, pi_mac, since=None, until=None):
+        """
+        Return the raw samples of a device as (time, is_eth_up, is_wlan_up)
+        tuples, oldest first.
+
+        Args:
+            since (datetime): Start time, defaults to the oldest sample.
+            until (datetime): End time, defaults to now.
+        """
+        rows = self._query(
+            "SELECT ts, eth, wlan FROM status WHERE mac = ? AND ts >= ? "
+            "AND ts <= ? ORDER BY ts",
+            (pi_mac, _to_ts(since) or 0, _to_ts(until) or time.time()))
+        return [(_to_datetime(ts), bool(eth), bool(wlan))
+                for ts, eth, wlan in rows]
+
+    def transitions(self, pi_mac, since=None):
+        """
+        Return the interface changes of a device as (time, iface, is_up)
+        tuples, oldest first, where iface is "eth" or "wlan".
+        """
+        changes = list()
+        previous = None
+        for ts, eth, wlan in self.history(pi_mac, since):
+            if previous is not None:
+                if eth != previous[0]:
+                    changes.append((ts, "eth", eth))
+                if wlan != previous[1]:
+                    changes.append((ts, "wlan", wlan))
+            previous = (eth, wlan)
+        return changes
+
+    def last_down(self, pi_mac, iface="eth"):
+        """
+        Return when an interface of a device last went down, or None.
+        """
+        column = {"eth": "eth", "wlan": "wlan"}[iface]
+        rows = self._query(
+            f"SELECT ts FROM (SELECT ts, {column} AS up, LAG({column}) OVER "
+            "(ORDER BY ts) AS prev FROM status WHERE mac = ?) "
+            "WHERE up = 0 AND prev = 1 ORDER BY ts DESC LIMIT 1",
+            (pi_mac,))
+        return _to_datetime(rows[0][0]) if rows else None
+
+    def uptime(self, pi_mac, since=None, until=None):
+        """
+        Summarize the samples of a device, raw and downsampled.
+
+        Returns:
+            A dict with the sample count, the share of samples with eth
+            and Wi-Fi up, and the first and last sample times, or None
+            without samples.
+        """
+        since = _to_ts(since) or 0
+        until = _to_ts(until) or time.time()
+        rows = self._query(
+            "SELECT sum(samples), sum(eth_up), sum(wlan_up), min(first), "
+            "max(last) FROM ("
+            "SELECT count(*) AS samples, sum(eth) AS eth_up, "
+            "sum(wlan) AS wlan_up, min(ts) AS first, max(ts) AS last "
+            "FROM status WHERE mac = ? AND ts >= ? AND ts <= ? "
+            "UNION ALL "
+            "SELECT sum(samples), sum(eth_up), sum(wlan_up), min(hour), "
+            "max(hour) FROM status_hourly WHERE mac = ? AND hour >= ? "
+            "AND hour <= ?)",
+            (pi_mac, since, until, pi_mac, since, until))
+        samples, eth_up, wlan_up, first, last = rows[0]
+        if not samples:
+            return None
+        return {
+            "samples": samples,
+            "eth": eth_up / samples,
+            "wlan": wlan_up / samples,
+            "first": _to_datetime(first),
+            "last": _to_datetime(last),
+        }
@@ -0,0 +1,80 @@
+from alerts import AlertTracker, CLEAR, RAISE
+
+
+def feed(tracker, key, samples):
+    """
+    Feed (time, bad) samples and return the (time, edge) pairs.
+    """
+    edges = list()
+    for now, bad in samples:
+        edge = tracker.update(key, bad, now)
+        if edge is not None:
+            edges.append((now, edge))
+    return edges
+
+
+def test_edges_without_debounce():
+    tracker = AlertTracker()
+    assert feed(tracker, "a", [(0, False), (1, True), (2, True), (3, False),
+                               (4, False)]) == [(1, RAISE), (3, CLEAR)]
+    assert tracker.active() == []
+
+
+def test_raise_after_debounce():
+    tracker = AlertTracker(raise_after=10)
+    # A short glitch does not raise
+    assert feed(tracker, "a", [(0, True), (5, True), (6, False)]) == []
+    assert feed(tracker, "a", [(7, True), (16, True), (17, True)]) == [
+        (17, RAISE)]
+    assert tracker.active() == ["a"]
+
+
+def test_clear_after_hysteresis():
+    tracker = AlertTracker(clear_after=10)
+    assert feed(tracker, "a", [(0, True), (1, False), (5, True),
+                               (6, False), (15, False), (16, False)]) == [
+        (0, RAISE), (16, CLEAR)]
+
+
+def test_cooldown_limits_flapping():
+    tracker = AlertTracker(cooldown=60)
+    samples = [(t, t % 20 < 10) for t in range(0, 140, 5)]
+    edges = feed(tracker, "a", samples)
+    assert [t for t, edge in edges if edge == RAISE] == [0, 60, 120]
+    # Every raise is cleared before the next one
+    assert [edge for _, edge in edges] == [RAISE, CLEAR] * 3
+
+
+def test_devices_are_independent():
+    tracker = AlertTracker(raise_after=5)
+    tracker.update("a", True, 0)
+    tracker.update("b", True, 3)
+    assert tracker.update("a", True, 5) == RAISE
+    assert tracker.update("b", True, 5) is None
+    assert tracker.update("b", True, 8) == RAISE
+    assert tracker.active() == ["a", "b"]
+
+
+def test_prime_sets_state_without_edge():
+    tracker = AlertTracker(cooldown=60)
+    tracker.prime("a", True, 0)
+    tracker.prime("b", False, 0)
+    assert tracker.active() == ["a"]
+    assert tracker.update("a", True, 1) is None
+    assert tracker.update("a", False, 2) == CLEAR
+    # The primed raise counts for the cooldown
+    assert tracker.update("a", True, 30) is None
+    assert tracker.update("a", True, 60) == RAISE
+
+
+def test_settled():
+    tracker = AlertTracker(raise_after=5, clear_after=5)
+    assert tracker.settled("a")
+    tracker.update("a", True, 0)
+    assert not tracker.settled("a")
+    tracker.update("a", True, 5)
+    assert tracker.settled("a")
+    tracker.update("a", False, 6)
+    assert not tracker.settled("a")
+    tracker.update("a", False, 11)
+    assert tracker.settled("a")
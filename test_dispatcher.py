@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+
+import dispatcher
+from dispatcher import PartitionedDispatcher
+
+
+class Gate:
+    """
+    Handler recording its calls, blocked on the first one until opened.
+    """
+
+    def __init__(self):
+        self.calls = list()
+        self.started = threading.Event()
+        self.opened = threading.Event()
+
+    def __call__(self, key, value):
+        self.started.set()
+        self.opened.wait(5)
+        self.calls.append((key, value))
+
+
+def busy_dispatcher(policy, max_queue=2):
+    gate = Gate()
+    pool = PartitionedDispatcher(gate, 1, max_queue, policy)
+    pool.submit("aa-01", "aa-01", 0)
+    # The worker holds message 0, the queue is empty
+    assert gate.started.wait(5)
+    return pool, gate
+
+
+@pytest.mark.parametrize("workers, max_queue", [(0, 10), (1, 0), (-1, 1)])
+def test_rejects_invalid_sizes(workers, max_queue):
+    with pytest.raises(ValueError):
+        PartitionedDispatcher(print, workers, max_queue)
+
+
+def test_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        PartitionedDispatcher(print, policy="drop-all")
+
+
+def test_messages_of_a_key_are_handled_in_order():
+    calls = list()
+    pool = PartitionedDispatcher(lambda key, i: calls.append((key, i)), 4)
+    for i in range(200):
+        key = f"aa-{i % 5:02d}"
+        pool.submit(key, key, i)
+    pool.join()
+    for k in range(5):
+        key = f"aa-{k:02d}"
+        assert [i for c, i in calls if c == key] == list(range(k, 200, 5))
+    assert pool.stats()["handled"] == 200
+
+
+def test_drop_newest():
+    pool, gate = busy_dispatcher(dispatcher.DROP_NEWEST)
+    assert pool.submit("aa-01", "aa-01", 1)
+    assert pool.submit("aa-01", "aa-01", 2)
+    assert not pool.submit("aa-01", "aa-01", 3)
+    gate.opened.set()
+    pool.join()
+    assert [i for _, i in gate.calls] == [0, 1, 2]
+    assert pool.stats()["dropped"] == 1
+
+
+def test_drop_oldest():
+    pool, gate = busy_dispatcher(dispatcher.DROP_OLDEST)
+    for i in range(1, 5):
+        assert pool.submit("aa-01", "aa-01", i)
+    gate.opened.set()
+    pool.join()
+    assert [i for _, i in gate.calls] == [0, 3, 4]
+    assert pool.stats()["dropped"] == 2
+
+
+def test_block_times_out(monkeypatch):
+    monkeypatch.setattr(dispatcher, "BLOCK_TIMEOUT_SEC", 0.05)
+    pool, gate = busy_dispatcher(dispatcher.BLOCK, max_queue=1)
+    assert pool.submit("aa-01", "aa-01", 1)
+    assert not pool.submit("aa-01", "aa-01", 2)
+    gate.opened.set()
+    pool.join()
+    assert [i for _, i in gate.calls] == [0, 1]
+    assert pool.stats()["dropped"] == 1
+
+
+def test_block_waits_for_room():
+    pool, gate = busy_dispatcher(dispatcher.BLOCK, max_queue=1)
+    assert pool.submit("aa-01", "aa-01", 1)
+    threading.Timer(0.05, gate.opened.set).start()
+    assert pool.submit("aa-01", "aa-01", 2)
+    pool.join()
+    assert [i for _, i in gate.calls] == [0, 1, 2]
+
+
+def test_handler_errors_are_counted():
+    def handler(value):
+        if value % 2:
+            raise RuntimeError(value)
+
+    pool = PartitionedDispatcher(handler, 2)
+    for i in range(10):
+        pool.submit(str(i), i)
+    pool.join()
+    stats = pool.stats()
+    assert stats["errors"] == 5
+    assert stats["handled"] == 10
+    assert stats["depth"] == 0
@@ -0,0 +1,31 @@
+import fanout
+
+RPI_IDS = {"aa-01": "RPI-1", "aa-02": "RPI-2", "aa-20": "RPI-20"}
+
+
+def test_split_spec_single_target():
+    assert fanout.split_spec("RPI-1 mqtt 20") == ("RPI-1", "mqtt 20")
+    assert fanout.split_spec("RPI-1") == ("RPI-1", "")
+
+
+def test_split_spec_comma_list_with_spaces():
+    assert fanout.split_spec("RPI-1, RPI-2") == ("RPI-1,RPI-2", "")
+    assert fanout.split_spec("RPI-1 ,RPI-2 mqtt") == ("RPI-1,RPI-2", "mqtt")
+    assert fanout.split_spec("RPI-1,  RPI-2 , RPI-20 hello world") == (
+        "RPI-1,RPI-2,RPI-20", "hello world")
+
+
+def test_resolve_comma_list_with_spaces():
+    spec, extras = fanout.split_spec("RPI-1, RPI-2 mqtt")
+    targets, unknown = fanout.resolve_targets(spec, RPI_IDS)
+    assert targets == {"RPI-1": "aa-01", "RPI-2": "aa-02"}
+    assert unknown == []
+    assert extras == "mqtt"
+
+
+def test_resolve_patterns_and_unknown():
+    targets, unknown = fanout.resolve_targets("RPI-2*,RPI-9", RPI_IDS)
+    assert targets == {"RPI-2": "aa-02", "RPI-20": "aa-20"}
+    assert unknown == ["RPI-9"]
+    targets, _ = fanout.resolve_targets("all", RPI_IDS)
+    assert len(targets) == 3
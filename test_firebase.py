@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+
+import firebase
+
+
+def event(event_type, path, data):
+    return SimpleNamespace(event_type=event_type, path=path, data=data)
+
+
+def registry(config):
+    reg = firebase.RpiRegistry(snapshot_path=None)
+    reg._on_event(event("put", "/", config))
+    return reg
+
+
+def test_put_assigns_id_to_unassigned_entry():
+    reg = registry({"k1": {"mac": "aa:bb"}})
+    reg._on_event(event("put", "/k1/rpi_id", "RPI-1"))
+    assert reg._mac_to_rpi == {"aa-bb": "RPI-1"}
+    assert reg._rpi_to_mac == {"RPI-1": "aa-bb"}
+
+
+def test_patch_assigns_id_to_unassigned_entry():
+    reg = registry({"k1": {"mac": "aa:bb"}})
+    reg._on_event(event("patch", "/k1", {"rpi_id": "RPI-1"}))
+    assert reg._mac_to_rpi == {"aa-bb": "RPI-1"}
+
+
+def test_delete_unassigned_entry():
+    reg = registry({"k1": {"mac": "aa:bb"},
+                    "k2": {"mac": "cc:dd", "rpi_id": "RPI-2"}})
+    reg._on_event(event("put", "/k1", None))
+    reg._on_event(event("patch", "/", {"k2/mac": None}))
+    assert "k1" not in reg._config
+    assert reg._mac_to_rpi == {}
+    assert reg._rpi_to_mac == {}
@@ -0,0 +1,173 @@
+import base64
+import gzip
+import io
+import zlib
+
+import pytest
+
+import log_transfer
+from log_transfer import LogDecoder, TransferAssembler, TransferError
+
+LOG = b"".join(b"line %d of the speedtest log\n" % i for i in range(500))
+
+
+def encoded(data, encoding="zlib+base64"):
+    if encoding == "gzip+base64":
+        data = gzip.compress(data)
+    else:
+        data = zlib.compress(data)
+    return base64.b64encode(data).decode()
+
+
+def parts(text, count, transfer_id="t1", encoding="zlib+base64"):
+    size = -(-len(text) // count)
+    return [{"transfer_id": transfer_id, "part": i, "total": count,
+             "out": {"log": text[i * size:(i + 1) * size],
+                     "encoding": encoding}}
+            for i in range(count)]
+
+
+def decode(text, encoding, max_bytes=log_transfer.MAX_LOG_BYTES):
+    decoder = LogDecoder(encoding, io.BytesIO(), max_bytes)
+    decoder.feed(text)
+    size = decoder.finish()
+    return decoder.sink.read(), size
+
+
+@pytest.mark.parametrize("encoding", ["zlib+base64", "gzip+base64"])
+def test_decode_compressed(encoding):
+    assert decode(encoded(LOG, encoding), encoding) == (LOG, len(LOG))
+
+
+def test_decode_plain():
+    assert decode("hello", None) == (b"hello", 5)
+
+
+def test_feed_splits_base64_groups():
+    text = encoded(LOG)
+    decoder = LogDecoder("zlib+base64", io.BytesIO())
+    for i in range(0, len(text), 7):
+        decoder.feed(text[i:i + 7])
+    assert decoder.finish() == len(LOG)
+    assert decoder.sink.read() == LOG
+
+
+@pytest.mark.parametrize("encoding", ["zlib+base64", "gzip+base64"])
+def test_truncated_compressed_log(encoding):
+    raw = base64.b64decode(encoded(LOG, encoding))
+    text = base64.b64encode(raw[:len(raw) // 2]).decode()
+    with pytest.raises(TransferError, match="Truncated compressed log"):
+        decode(text, encoding)
+
+
+def test_truncated_base64():
+    with pytest.raises(TransferError, match="Truncated base64"):
+        decode(encoded(LOG)[:-1], "zlib+base64")
+
+
+def test_size_cap():
+    with pytest.raises(TransferError, match="larger than"):
+        decode("x" * 11, None, max_bytes=10)
+    # A compression bomb stops at the cap
+    bomb = encoded(b"\0" * (1024 * 1024))
+    with pytest.raises(TransferError, match="larger than"):
+        decode(bomb, "zlib+base64", max_bytes=1000)
+
+
+def test_unknown_encoding():
+    with pytest.raises(TransferError, match="Unknown"):
+        LogDecoder("bz2+base64", io.BytesIO())
+
+
+def test_assemble_out_of_order_with_duplicates():
+    assembler = TransferAssembler()
+    chunks = parts(encoded(LOG), 4)
+    for msg in [chunks[2], chunks[0], chunks[2], chunks[3]]:
+        assert assembler.add("aa-01", msg) is None
+    spool, size = assembler.add("aa-01", chunks[1])
+    with spool:
+        assert spool.read() == LOG
+    assert size == len(LOG)
+    assert assembler.depth() == 0
+
+
+def test_transfers_of_devices_are_separate():
+    assembler = TransferAssembler()
+    first = parts(encoded(b"first\n"), 2)
+    second = parts(encoded(b"second\n"), 2)
+    assembler.add("aa-01", first[0])
+    assembler.add("aa-02", second[0])
+    assert assembler.depth() == 2
+    spool, _ = assembler.add("aa-02", second[1])
+    with spool:
+        assert spool.read() == b"second\n"
+    spool, _ = assembler.add("aa-01", first[1])
+    with spool:
+        assert spool.read() == b"first\n"
+
+
+def test_late_part_of_completed_transfer_is_dropped():
+    assembler = TransferAssembler()
+    chunks = parts(encoded(LOG), 2)
+    assembler.add("aa-01", chunks[0])
+    assembler.add("aa-01", chunks[1])[0].close()
+    # QoS 1 redelivery after the last part
+    assert assembler.add("aa-01", chunks[1]) is None
+    assert assembler.add("aa-01", chunks[0]) is None
+    assert assembler.depth() == 0
+
+
+def test_remaining_parts_of_failed_transfer_are_dropped():
+    assembler = TransferAssembler(max_bytes=10)
+    chunks = parts("x" * 40, 4, encoding="plain")
+    assert assembler.add("aa-01", chunks[0]) is None
+    with pytest.raises(TransferError, match="larger than"):
+        assembler.add("aa-01", chunks[1])
+    for msg in chunks[1:]:
+        assert assembler.add("aa-01", msg) is None
+    assert assembler.depth() == 0
+
+
+def test_buffered_parts_cap():
+    assembler = TransferAssembler(max_bytes=10)
+    chunks = parts("x" * 40, 8, encoding="plain")
+    with pytest.raises(TransferError, match="Too many parts buffered"):
+        for msg in reversed(chunks):
+            assembler.add("aa-01", msg)
+    assert assembler.depth() == 0
+
+
+def test_invalid_part_index():
+    assembler = TransferAssembler()
+    msg = parts("abc", 2, encoding="plain")[0]
+    msg["part"] = 5
+    with pytest.raises(TransferError, match="Invalid part"):
+        assembler.add("aa-01", msg)
+    assert assembler.depth() == 0
+
+
+def test_malformed_part_does_not_leak_transfer():
+    assembler = TransferAssembler()
+    msg = parts("abc", 2, encoding="plain")[0]
+    del msg["out"]["log"]
+    with pytest.raises(KeyError):
+        assembler.add("aa-01", msg)
+    assert assembler.depth() == 0
+
+
+def test_overflow_evicts_oldest_transfer():
+    assembler = TransferAssembler(max_transfers=2)
+    for transfer_id in ("t1", "t2", "t3"):
+        assembler.add("aa-01", parts("abcd", 2, transfer_id, "plain")[0])
+    assert assembler.depth() == 2
+    assert ("aa-01", "t1") not in assembler._transfers
+
+
+def test_stale_transfer_is_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(log_transfer.time, "monotonic", lambda: now[0])
+    assembler = TransferAssembler(ttl_sec=10)
+    assembler.add("aa-01", parts("abcd", 2, "t1", "plain")[0])
+    now[0] += 11
+    assembler.add("aa-01", parts("abcd", 2, "t2", "plain")[0])
+    assert list(assembler._transfers) == [("aa-01", "t2")]
@@ -0,0 +1,101 @@
+from staleness import StalenessIndex
+
+
+def index(slots=4096):
+    # Thresholds of 10 and 20 ticks of one second
+    return StalenessIndex((10, 20), resolution_sec=1, slots=slots, now=0)
+
+
+def crossings(idx, start, end):
+    """
+    Advance tick by tick and return the (time, key, threshold) crossings.
+    """
+    found = list()
+    for now in range(start, end + 1):
+        found.extend((now, key, threshold)
+                     for key, threshold in idx.advance(now))
+    return found
+
+
+def test_crossings_at_thresholds():
+    idx = index()
+    idx.seen("a", 0)
+    idx.seen("b", 5)
+    assert crossings(idx, 1, 30) == [
+        (10, "a", 10), (15, "b", 10), (20, "a", 20), (25, "b", 20)]
+
+
+def test_report_moves_deadline():
+    idx = index()
+    idx.seen("a", 0)
+    assert idx.seen("a", 8) == []
+    assert idx.last_seen("a") == 8
+    assert crossings(idx, 1, 30) == [(18, "a", 10), (28, "a", 20)]
+
+
+def test_recovery_and_new_crossing():
+    idx = index()
+    idx.seen("a", 0)
+    assert crossings(idx, 1, 12) == [(10, "a", 10)]
+    assert idx.seen("a", 12) == [10]
+    assert crossings(idx, 13, 22) == [(22, "a", 10)]
+    assert idx.seen("a", 23) == [10]
+
+
+def test_older_report_is_ignored():
+    idx = index()
+    idx.seen("a", 8)
+    assert idx.seen("a", 5) == []
+    assert idx.last_seen("a") == 8
+
+
+def test_wheel_wrap_around():
+    # Thresholds span several revolutions of a 4-slot wheel
+    idx = index(slots=4)
+    idx.seen("a", 0)
+    idx.seen("b", 3)
+    assert crossings(idx, 1, 25) == [
+        (10, "a", 10), (13, "b", 10), (20, "a", 20), (23, "b", 20)]
+
+
+def test_long_pause():
+    idx = index(slots=4)
+    idx.seen("a", 0)
+    idx.seen("b", 12)
+    assert idx.advance(27) == [("a", 10), ("b", 10), ("a", 20)]
+    assert idx.advance(40) == [("b", 20)]
+    assert idx.advance(100) == []
+
+
+def test_report_older_than_thresholds():
+    # A retained report already past both thresholds when first seen
+    idx = StalenessIndex((10, 20), resolution_sec=1, slots=4, now=100)
+    idx.seen("a", 50)
+    idx.seen("b", 85)
+    assert idx.advance(100) == [("a", 10), ("b", 10), ("a", 20)]
+    assert idx.advance(105) == [("b", 20)]
+
+
+def test_forget():
+    idx = index()
+    idx.seen("a", 0)
+    idx.forget("a")
+    assert idx.last_seen("a") is None
+    assert crossings(idx, 1, 30) == []
+    # Seen again after forget, the old entries do not fire twice
+    idx = index()
+    idx.seen("a", 0)
+    idx.forget("a")
+    idx.seen("a", 2)
+    assert len(idx) == 1
+    assert crossings(idx, 1, 30) == [(12, "a", 10), (22, "a", 20)]
+
+
+def test_coarse_resolution():
+    idx = StalenessIndex((120, 600), resolution_sec=60, slots=8, now=0)
+    idx.seen("a", 30)
+    # Due in the tick of 120-179, but only 150 seconds after the report
+    assert idx.advance(149) == []
+    assert idx.advance(150) == [("a", 120)]
+    assert idx.advance(629) == []
+    assert idx.advance(630) == [("a", 600)]